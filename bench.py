@@ -0,0 +1,362 @@
+import argparse
+import ast
+import collections
+import datetime
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from gspread.exceptions import APIError, WorksheetNotFound
+from streamlit import config, logger
+from streamlit.delta_generator_singletons import get_dg_singleton_instance
+
+from metrics import Metrics
+
+# --- ベンチマーク ---
+# 合成データ (店舗・従業員・記録) を擬似 Sheets 接続に載せて main.py を動かし、
+# 読み込み・更新・インデックス構築・画面描画の時間を計測する。
+# 擬似接続は API 呼び出しごとに遅延を入れられる (実際の Sheets は 1回 100〜500ms 程度)。
+# --sheets-quota を付けると、擬似接続が1分あたりの件数を超えた呼び出しを 429 で断る
+# (アプリ側の上限 --client-quota との組み合わせで、再試行・待ち合わせの動きを確かめられる)。
+#   python bench.py --scale 1k 100k --latency 0.1 --repeat 3 --out bench.jsonl
+#   python bench.py --scale 1k --sheets-quota 60 --client-quota 50
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+SCALES = {  # 記録, 店舗, 従業員
+    "1k": (1_000, 50, 30),
+    "100k": (100_000, 2_000, 300),
+    "1m": (1_000_000, 10_000, 1_000),
+}
+
+# --- 擬似 Sheets 接続 (GSheetsStorage が使う gspread の操作だけを実装) ---
+def _a1(ref):
+    # "B12" -> (12, 2)。行・列が省略されていれば None
+    m = re.match(r"([A-Z]*)(\d*)$", ref)
+    col = 0
+    for ch in m.group(1): col = col * 26 + ord(ch) - 64
+    return (int(m.group(2)) if m.group(2) else None), (col or None)
+
+class FakeWorksheet:
+    def __init__(self, conn, title, rows=None):
+        self.conn = conn
+        self.title = title
+        self.id = title
+        self.rows = rows or []
+        self.col_count = max([26] + [len(r) for r in self.rows[:1]])
+        self.spreadsheet = FakeSpreadsheet(self)
+
+    def row_values(self, i):
+        self.conn.api("row_values")
+        return list(self.rows[i - 1]) if i <= len(self.rows) else []
+
+    def col_values(self, c):
+        self.conn.api("col_values")
+        out = [r[c - 1] if c <= len(r) else "" for r in self.rows]
+        while out and out[-1] == "": out.pop()
+        return out
+
+    def get_all_values(self):
+        self.conn.api("get_all_values")
+        return [list(r) for r in self.rows]
+
+    def _get(self, rng):
+        a, b = rng.split(":") if ":" in rng else (rng, rng)
+        (r1, c1), (r2, c2) = _a1(a), _a1(b)
+        r1, r2, c1 = r1 or 1, r2 or len(self.rows), c1 or 1
+        return [r[c1 - 1:c2] if c2 else r[c1 - 1:] for r in self.rows[r1 - 1:r2]]
+
+    def batch_get(self, ranges, **kw):
+        self.conn.api("batch_get")
+        return [self._get(r) for r in ranges]
+
+    def batch_update(self, data, **kw):
+        self.conn.api("batch_update")
+        for d in data:
+            r, c = _a1(d['range'].split(":")[0])
+            for i, values in enumerate(d['values']):
+                while len(self.rows) < r + i: self.rows.append([])
+                row = self.rows[r - 1 + i]
+                for j, v in enumerate(values):
+                    while len(row) < c + j: row.append("")
+                    row[c - 1 + j] = "" if v is None else str(v)
+
+    def append_rows(self, values, **kw):
+        self.conn.api("append_rows")
+        start = len(self.rows) + 1
+        self.rows += [["" if v is None else str(v) for v in r] for r in values]
+        return {'updates': {'updatedRange': f"{self.title}!A{start}:Z{len(self.rows)}"}}
+
+    def add_cols(self, n):
+        self.conn.api("add_cols")
+        self.col_count += n
+
+class FakeSpreadsheet:
+    def __init__(self, ws):
+        self.ws = ws
+
+    def batch_update(self, body):
+        self.ws.conn.api("spreadsheet_batch_update")
+        for r in body['requests']:
+            d = r['deleteDimension']['range']
+            del self.ws.rows[d['startIndex']:d['endIndex']]
+
+class FakeClient:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _select_worksheet(self, worksheet=None, **kw):
+        self.conn.api("open_worksheet")
+        if worksheet not in self.conn.sheets: raise WorksheetNotFound(worksheet)
+        return self.conn.sheets[worksheet]
+
+    def _open_spreadsheet(self):
+        return self
+
+    def add_worksheet(self, title, rows=0, cols=0):
+        self.conn.api("add_worksheet")
+        self.conn.sheets[title] = FakeWorksheet(self.conn, title)
+        return self.conn.sheets[title]
+
+class QuotaExceeded:
+    # 上限超過時の Sheets API の応答 (gspread の APIError に渡す)
+    status_code = 429
+    text = "Quota exceeded"
+
+    def json(self):
+        return {'error': {'code': 429, 'message': "Quota exceeded for quota metric 'Requests'", 'status': "RESOURCE_EXHAUSTED"}}
+
+class FakeSheetsConnection:
+    # GSheetsConnection の代わり。API 呼び出しごとに latency 秒待ち、回数を数える。
+    # quota を指定すると直近1分の呼び出しがその件数に達した時点で 429 を返す
+    def __init__(self, latency=0.0, quota=None):
+        self.latency = latency
+        self.quota = quota
+        self.sheets = {}
+        self.calls = 0
+        self.rejected = 0
+        self.recent = collections.deque()
+        self.lock = threading.Lock()
+        self.client = FakeClient(self)
+
+    def api(self, name):
+        if self.latency: time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            if self.quota:
+                now = time.monotonic()
+                while self.recent and now - self.recent[0] > 60: self.recent.popleft()
+                if len(self.recent) >= self.quota:
+                    self.rejected += 1
+                    raise APIError(QuotaExceeded())
+                self.recent.append(now)
+
+    def add_sheet(self, title, rows):
+        self.sheets[title] = FakeWorksheet(self, title, [list(map(str, r)) for r in rows])
+
+# --- 合成データ ---
+def _app_constant(name):
+    # main.py の列定義をそのまま使う (import すると画面が動くので構文木から読む)
+    tree = ast.parse(open(APP_PATH, encoding="utf-8").read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, 'id', None) == name for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise KeyError(name)
+
+def generate(conn, n_visits, n_stores, n_employees, seed=0):
+    rng = np.random.default_rng(seed)
+    stores = np.array([f"店舗{i:05d}" for i in range(n_stores)])
+    employees = np.array([f"社員{i:04d}" for i in range(n_employees)])
+    visit_columns, store_columns = _app_constant("VISIT_COLUMNS"), _app_constant("STORE_COLUMNS")
+
+    # 記録は直近2年に散らばらせる (アーカイブ対象にならない範囲)
+    today = np.datetime64(datetime.date.today())
+    start = rng.integers(8, 18, n_visits)
+    a, b = employees[rng.integers(0, n_employees, n_visits)], employees[rng.integers(0, n_employees, n_visits)]
+    visits = pd.DataFrame({
+        'id': np.arange(1, n_visits + 1),
+        'store_name': stores[rng.integers(0, n_stores, n_visits)],
+        'visit_date': (today - rng.integers(0, 730, n_visits)).astype(str),
+        'visit_time': "",
+        'start_time': [f"{h:02d}:00" for h in start],
+        'end_time': [f"{h:02d}:30" for h in start + rng.integers(1, 4, n_visits)],
+        'rating': rng.integers(0, 6, n_visits),
+        'members': np.char.add(np.char.add(a, ", "), b),
+        'sv_members': employees[rng.integers(0, n_employees, n_visits)],
+        'count_area': rng.choice(["1F", "2F", "B1", ""], n_visits),
+        'notices': "", 'memo': "",
+        'record_memo': np.char.add("メモ", np.arange(n_visits).astype(str)),
+    })[visit_columns].astype(str)
+    conn.add_sheet("visits", [visit_columns] + visits.values.tolist())
+    conn.add_sheet("stores", [store_columns] + [[s, f"注意{i}", f"メモ{i}"] for i, s in enumerate(stores)])
+    conn.add_sheet("employees", [['name']] + [[e] for e in employees])
+    return {'stores': list(stores), 'employees': list(employees), 'visits': n_visits}
+
+# --- 実行 ---
+def load_app(conn):
+    # main.py をベアモード (streamlit run なし) で実行し、関数を取り出す
+    st.connection = lambda *a, **k: conn
+    st.cache_resource.clear()  # 前の規模の接続・レプリカを引き継がない
+    app = {'__name__': "bench_app"}
+    exec(compile(open(APP_PATH, encoding="utf-8").read(), APP_PATH, "exec"), app)
+    # ベアモードの st.form はプロセス共通の main_dg にフォーム情報を残すので消しておく
+    # (残っていると後の AppTest でボタンが「フォームの中」と判定される)
+    get_dg_singleton_instance().main_dg._form_data = None
+    return app
+
+def reset_app(app):
+    # 次の読み込みを初回と同じ状態にする (レプリカ・インデックスを捨てる)
+    for r in app['replicas'].values():
+        r.header, r.synced, r._view = None, 0.0, None
+    app['_index_cache']().clear()
+
+class Bench:
+    def __init__(self, conn, repeat, tags):
+        self.conn = conn
+        self.repeat = repeat
+        self.tags = tags
+        self.metrics = Metrics(maxlen=100_000)
+
+    def time(self, name, fn, setup=None, repeat=None):
+        for _ in range(repeat or self.repeat):
+            if setup: setup()
+            calls = self.conn.calls
+            start = time.perf_counter()
+            fn()
+            self.metrics.record("bench", name, time.perf_counter() - start, api_calls=self.conn.calls - calls, **self.tags)
+
+def run_scale(scale, latency, repeat, quota=None):
+    n_visits, n_stores, n_employees = SCALES[scale]
+    conn = FakeSheetsConnection()
+    t0 = time.perf_counter()
+    data = generate(conn, n_visits, n_stores, n_employees)
+    print(f"[{scale}] 合成データ {n_visits:,}件 ({time.perf_counter() - t0:.1f}s)", flush=True)
+
+    # 起動 (初回読み込み + 全画面の描画) は遅延なしで1回だけ
+    t0 = time.perf_counter()
+    app = load_app(conn)
+    app['write_queue'].timer and app['write_queue'].timer.cancel()
+    startup = time.perf_counter() - t0
+    conn.latency, conn.quota = latency, quota
+    bench = Bench(conn, repeat, {'scale': scale, 'latency': latency, 'quota': quota})
+    bench.metrics.record("bench", "startup(bare)", startup, api_calls=0, **bench.tags)
+
+    store = data['stores'][0]
+    today = datetime.date.today()
+    members = app['get_members_data']
+    replicas = app['replicas']
+
+    # 読み込み
+    bench.time("load:visits(cold)", app['get_visits_data'], setup=lambda: reset_app(app))
+    bench.time("load:visits(warm)", app['get_visits_data'])
+    def expire():
+        with replicas['visits'].lock: replicas['visits'].synced = 0.0  # 裏の同期が終わるのを待ってから
+    bench.time("load:visits(stale)", app['get_visits_data'], setup=expire)  # 期限切れでも待たずに返る
+    bench.time("sync:visits(delta)", replicas['visits'].refresh, setup=expire)
+    bench.time("load:stores(cold)", app['get_stores_data'], setup=lambda: reset_app(app))
+    bench.time("load:visit_members(cold)", members, setup=lambda: reset_app(app))
+    bench.time("load:preload(all sheets)", app['preload'], setup=lambda: reset_app(app))
+
+    # インデックス (データは読み込み済みの状態で構築だけを計る)
+    def drop_indexes(): app['_index_cache']().clear()
+    app['get_visits_data'](); app['get_stores_data'](); members()
+    bench.time("index:date", app['get_date_index'], setup=drop_indexes)
+    bench.time("index:search", app['get_search_index'], setup=drop_indexes)
+    bench.time("index:members", app['get_member_index'], setup=drop_indexes)
+    bench.time("index:store_summary", app['get_store_summary'], setup=drop_indexes)
+    bench.time("index:visit_repo", app['get_visit_repo'], setup=drop_indexes)
+    bench.time("index:store_repo", app['get_store_repo'], setup=drop_indexes)
+    app['flush_writes']()  # 移行分の visit_members を書いておく
+
+    # カレンダー・検索
+    bench.time("calendar:month", lambda: app['month_visits_map'](today.year, today.month))
+    bench.time("calendar:day", lambda: app['visits_on_date'](today))
+    bench.time("calendar:member_counts", lambda: app['month_member_counts'](today.year, today.month))
+    bench.time("search:store", lambda: app['get_search_index']().search(store[:4], ["store"]))
+    bench.time("search:all", lambda: app['get_search_index']().search(f"{data['employees'][0]} メモ1", ["store", "member", "memo"]))
+    bench.time("lookup:visit_by_id", lambda: app['get_visit_repo']().row(data['visits'] // 2))
+    bench.time("lookup:store_visits", lambda: app['get_visit_repo']().store_visits(store, today - datetime.timedelta(days=90), today))
+
+    # 更新 (キューに積むまで) と送信
+    ids = []
+    def add():
+        rec = {"store_name": store, "visit_date": today.strftime("%Y-%m-%d"), "visit_time": "", "start_time": "10:00", "end_time": "12:00",
+               "rating": 3, "members": ", ".join(data['employees'][:2]), "sv_members": data['employees'][2], "count_area": "", "notices": "", "memo": "", "record_memo": "bench"}
+        app['add_visit_data'](rec)
+        ids.append(rec['id'])
+    bench.time("mutate:add_visit", add)
+    bench.time("mutate:update_visit", lambda: app['update_visit_data'](ids[-1], {"record_memo": f"bench {time.time()}", "members": data['employees'][3]}))
+    bench.time("mutate:delete_visit", lambda: app['delete_visit_data'](ids.pop()))
+    bench.time("mutate:register_store", lambda: app['register_new_store'](f"新店{time.time_ns()}", "", ""))
+    bench.time("mutate:update_store_info", lambda: app['update_store_info'](store, f"注意 {time.time()}", "メモ"))
+    bench.time("mutate:add_employees", lambda: app['check_and_add_employees']([f"新人{time.time_ns()}"]))
+    bench.time("flush", app['flush_writes'], setup=add)
+    # 保存して送信した後も、集計・検索索引は差分を当てたものをそのまま使う (作り直さない)
+    bench.time("after_write:store_summary", app['get_store_summary'], setup=lambda: (add(), app['flush_writes']()))
+    bench.time("after_write:search", app['get_search_index'], setup=lambda: (add(), app['flush_writes']()))
+
+    # 画面 (AppTest で1回分の再実行を計る。データはプロセス内のキャッシュを共有する)
+    from streamlit.testing.v1 import AppTest
+    screens = {
+        "screen:calendar_month": {},
+        "screen:calendar_day": {'cal_view_mode': 'day', 'cal_selected_date': today},
+        "screen:store_detail": {'main_tab': "店舗一覧・検索", 'selected_store': store},
+        "screen:add_visit": {'main_tab': "店舗一覧・検索", 'selected_store': store, 'search_add_mode': True},
+        "screen:edit_visit": {'main_tab': "店舗一覧・検索", 'selected_store': store, 'edit_record_id': int(app['get_visits_data']()['id'].iloc[0])},
+        "screen:store_list": {'main_tab': "店舗一覧・検索"},
+    }
+    for name, state in screens.items():
+        at = AppTest.from_file(APP_PATH, default_timeout=600)
+        for k, v in state.items(): at.session_state[k] = v
+        at.run()  # 初回はセッションの初期化を含むので捨てる
+        bench.time(name, at.run)
+        if at.exception: print(f"  {name}: {at.exception[0].message}")
+    return bench.metrics, app['metrics']
+
+def _rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(APP_PATH)).stdout.strip()
+    except Exception:
+        return ""
+
+def main():
+    parser = argparse.ArgumentParser(description="店舗記録ログのベンチマーク")
+    parser.add_argument("--scale", nargs="+", default=["1k"], choices=list(SCALES))
+    parser.add_argument("--latency", type=float, default=0.0, help="API 呼び出し1回あたりの遅延 (秒)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--sheets-quota", type=int, help="擬似接続が受け付ける1分あたりの件数 (超えると 429)")
+    parser.add_argument("--client-quota", type=int, default=1_000_000, help="アプリ側の上限 (SHEETS_QUOTA_PER_MINUTE)")
+    parser.add_argument("--out", help="結果を JSON Lines で追記するファイル")
+    args = parser.parse_args()
+    os.environ["SHEETS_QUOTA_PER_MINUTE"] = str(args.client_quota)
+
+    config.set_option("logger.level", "error")
+    logger.set_log_level("error")
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    os.chdir(tempfile.mkdtemp(prefix="bench_"))  # 書き込みジャーナルを作業ディレクトリに置く
+    rev = _rev()
+
+    for scale in args.scale:
+        results, app_metrics = run_scale(scale, args.latency, args.repeat, args.sheets_quota)
+        summary = results.summary().drop(columns=['kind'])
+        calls = pd.DataFrame(results.events).groupby('name')['api_calls'].mean().round(1)
+        summary['API回数'] = summary['name'].map(calls)
+        with pd.option_context("display.width", 200, "display.max_rows", 200):
+            print(summary.to_string(index=False))
+            storage = app_metrics.summary()
+            if not storage.empty:
+                print("\n-- storage (main.py の計測) --")
+                print(storage[storage['kind'].isin(["storage", "api"])].to_string(index=False))
+        if args.out:
+            with open(args.out, "a", encoding="utf-8") as f:
+                for e in results.events: f.write(json.dumps({**e, 'rev': rev}, ensure_ascii=False) + "\n")
+    os._exit(0)  # 書き込みキューのタイマーを待たない
+
+if __name__ == "__main__":
+    main()
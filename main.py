@@ -1,10 +1,22 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+from streamlit.errors import StreamlitAPIException
 from streamlit_gsheets import GSheetsConnection
 import datetime
 import calendar
 import jpholiday
 import re
+import os
+import json
+import threading
+import time
+import unicodedata
+import io
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from storage import ApiScheduler, GSheetsStorage, SQLiteStorage, TimedStorage, background_calls, to_cell
+from metrics import Metrics
 
 # --- 1. ページ設定 ---
 st.set_page_config(page_title="店舗記録ログ", layout="centered")
@@ -83,129 +95,1146 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- 3. データベース接続 ---
-conn = st.connection("gsheets", type=GSheetsConnection)
+# 計測: PERF_LOG_PATH を指定すると計測結果を JSON Lines で追記する
+@st.cache_resource
+def get_metrics():
+    return Metrics(log_path=os.environ.get("PERF_LOG_PATH"))
+
+metrics = get_metrics()
+
+# STORAGE_BACKEND=sqlite でローカルの SQLite を使う (大規模店舗・オフライン・負荷試験用)
+# SHEETS_QUOTA_PER_MINUTE: Sheets API を1分あたり何件まで送るか (読み取り・書き込みそれぞれ。全セッション合計)
+@st.cache_resource
+def get_storage():
+    if os.environ.get("STORAGE_BACKEND", "gsheets") == "sqlite":
+        backend = SQLiteStorage(os.environ.get("SQLITE_PATH", "store_log.db"))
+    else:
+        quota = int(os.environ.get("SHEETS_QUOTA_PER_MINUTE", 60))
+        scheduler = ApiScheduler({'read': quota, 'write': quota}, metrics=metrics)
+        backend = GSheetsStorage(st.connection("gsheets", type=GSheetsConnection), scheduler)
+    return TimedStorage(backend, metrics)
+
+storage = get_storage()
 
 # --- データ操作 ---
-@st.cache_data(ttl=60)
+VISIT_COLUMNS = ['id', 'store_name', 'visit_date', 'visit_time', 'start_time', 'end_time', 'rating', 'members', 'sv_members', 'count_area', 'notices', 'memo', 'record_memo']
+STORE_COLUMNS = ['store_name', 'notices', 'memo']
+MEMBER_COLUMNS = ['member_key', 'visit_id', 'person', 'role']  # visit_members: 記録 ↔ 人 (role: sv / member)
+# visit_archive: アーカイブ済みの記録の 年×店舗 ごとの集計 (part_key = "年|店舗名")
+ARCHIVE_COLUMNS = ['part_key', 'year', 'store_name', 'count', 'rating_sum', 'rating_count', 'last_date', 'last_sv', 'last_members']
+WORKSHEET_KEYS = {
+    "visits": ("id", VISIT_COLUMNS),
+    "stores": ("store_name", STORE_COLUMNS),
+    "employees": ("name", ['name']),
+    "visit_members": ("member_key", MEMBER_COLUMNS),
+    "visit_archive": ("part_key", ARCHIVE_COLUMNS),
+}
+
+# --- ローカルレプリカ (差分同期) ---
+# 前回のスナップショットを保持し、キー列と updated_at 列だけを読んで
+# 追加・変更された行だけを取得する。同期コストは全件数ではなく変更件数に比例する。
+# 同期は裏のスレッドで行い、画面は常に手元のスナップショットをすぐ返す (初回の読み込みだけ待つ)。
+SYNC_INTERVAL = 60
+REFRESH_AHEAD = 0.8  # SYNC_INTERVAL のこの割合が過ぎたら、期限切れを待たずに裏で同期を始める
+# 差分同期は updated_at が変わった行しか読まないので、シート上で直接書き換えたセルは拾えない。
+# この回数に1回は全件を読み直して突き合わせる (内容が同じなら差し替えない)
+FULL_SYNC_EVERY = 10
+UPDATED_AT = 'updated_at'
+STAMPED_WORKSHEETS = ("visits", "stores")
+
+def _now_stamp():
+    return datetime.datetime.now().isoformat(timespec="microseconds")
+
+def _rows_to_frame(header, rows):
+    width = len(header)
+    return pd.DataFrame([(r + [""] * width)[:width] for r in rows], columns=header)
+
+def _cells(s):
+    # 型付きの値と文字列が混ざった列 (変更の適用後) をいったん文字列に揃える
+    return s.map(to_cell) if s.dtype == object else s
+
+def _to_dates(s):
+    if pd.api.types.is_datetime64_any_dtype(s): return s
+    return pd.to_datetime(_cells(s), format="%Y-%m-%d", errors='coerce')
+
+def _to_times(s):
+    # "HH:MM" -> 0時からの経過時間 (timedelta64)。空欄は NaT
+    if pd.api.types.is_timedelta64_dtype(s): return s
+    t = pd.to_datetime(_cells(s), format="%H:%M", errors='coerce')
+    return t - t.dt.normalize()
+
+def _normalize(df, worksheet):
+    if worksheet == "visits": return _type_visits(df)
+    df = df.fillna("")
+    if worksheet == "visit_members":
+        df['visit_id'] = pd.to_numeric(df['visit_id'], errors='coerce').fillna(0).astype(int)
+    return df
+
+def _type_visits(df):
+    # 記録は型付きで持つ: store_name=category, visit_date=datetime64, rating=int8,
+    # start/end_time=timedelta64, その他は文字列 (空欄は "")。型が揃っている列は何もしない
+    df = df.copy()
+    for c in VISIT_COLUMNS:
+        if c not in df.columns: df[c] = ""
+    for c in df.columns:
+        s = df[c]
+        if c == 'id':
+            if s.dtype != np.int64: df[c] = pd.to_numeric(_cells(s), errors='coerce').fillna(0).astype(np.int64)
+        elif c == 'rating':
+            if s.dtype != np.int8: df[c] = pd.to_numeric(_cells(s), errors='coerce').fillna(0).clip(0, 5).astype(np.int8)
+        elif c == 'visit_date':
+            df[c] = _to_dates(s)
+        elif c in ('start_time', 'end_time'):
+            df[c] = _to_times(s)
+        elif c == 'store_name':
+            if not isinstance(s.dtype, pd.CategoricalDtype): df[c] = s.fillna("").astype(str).astype('category')
+        elif not isinstance(s.dtype, pd.StringDtype) or s.hasnans:
+            df[c] = s.fillna("").astype("string")
+    return df
+
+def _same_rows(a, b):
+    # 見える内容が同じか (読み込み方で型が違う列だけ文字列にして比べる)
+    if len(a) != len(b) or set(a.columns) != set(b.columns): return False
+    a, b = a.reset_index(drop=True), b.reset_index(drop=True)
+    for c in a.columns:
+        x, y = a[c], b[c]
+        same = x.equals(y) if x.dtype == y.dtype else (x.astype(str).to_numpy() == y.astype(str).to_numpy()).all()
+        if not same: return False
+    return True
+
+class SheetReplica:
+    def __init__(self, worksheet, key_col, columns, schema=None, interval=SYNC_INTERVAL):
+        self.worksheet = worksheet
+        self.schema = schema or worksheet  # 型変換の種類 (年別アーカイブは "visits")
+        self.interval = interval
+        self.key_col = key_col
+        self.header = None
+        self.df = _normalize(pd.DataFrame(columns=columns), self.schema)
+        self.synced = 0.0
+        self.used = 0.0
+        self.syncs = 0
+        self.version = 0
+        self._view = None
+        self.lock = threading.Lock()
+        self.timer = None
+        self.error = None  # 直近の同期の失敗 (画面に表示する)
+
+    def get(self):
+        self.used = time.time()
+        age = time.time() - self.synced
+        if self.header is None:
+            # 初回は返せるスナップショットがないので読み込みを待つ
+            if age > self.interval: self.refresh()
+        elif age > self.interval * REFRESH_AHEAD:
+            # 期限が近い (切れた): 前回のスナップショットをすぐ返し、裏で同期する
+            self._schedule(0)
+        return self.df
+
+    def refresh(self):
+        # 同期して差し替える。同時に呼ばれても同期は1回だけ
+        with self.lock:
+            if self.timer is threading.current_thread(): self.timer = None
+            if time.time() - self.synced < self.interval * REFRESH_AHEAD / 2: return  # 直前に他のスレッドが同期済み
+            try:
+                with metrics.timer("sync", self.worksheet): self.sync()
+                self.error = None
+            except Exception as e:
+                self.error = e  # スナップショットは前回のまま
+            finally:
+                self.synced = time.time()
+        # 読まれている間は期限の前に次の同期を入れておく (使われなくなったら止まる)
+        if time.time() - self.used < self.interval: self._schedule(self.interval * REFRESH_AHEAD)
+
+    def _schedule(self, delay):
+        if self.timer and self.timer.is_alive():
+            if delay or self.timer.finished.is_set(): return
+            self.timer.cancel()  # 期限切れ: 予約を前倒しする
+        self.timer = threading.Timer(delay, self._refresh_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _refresh_background(self):
+        # 裏の同期は画面からの読み込みより後回し (API の上限に近い時)
+        with background_calls(): self.refresh()
+
+    def invalidate(self):
+        self.synced = 0.0
+
+    def _swap(self, header, df, bump=True):
+        # 新しいスナップショットに差し替える。読む側は版 → df の順に読むので、df を先に替える
+        self.header, self.df = header, df
+        if bump: self.version += 1
+
+    def patch(self, ops, header, as_queued=True):
+        # 書き込んだ行をそのままスナップショットに反映する (再読込しない)。
+        # as_queued: 書いた内容がキューに積んだ変更そのまま。画面には未送信の変更として既に
+        # 重ねてあるので、見える内容は変わらない → 版は進めない (インデックスを作り直させない)
+        with self.lock:
+            if self.header is None: return self.invalidate()
+            df = _apply_ops(self.df, ops, self.schema, self.key_col)
+            self._swap(header, df, bump=not as_queued)
+
+    def view(self, ops, ops_version):
+        # スナップショット + 未送信の変更。どちらのバージョンも変わらなければ前回の結果を返す
+        # (版を先に読む。間に差し替わっても、次の呼び出しで作り直される)
+        key = (self.version, ops_version)
+        df = self.get()
+        hit = self._view is not None and self._view[0] == key
+        metrics.hit(f"view:{self.worksheet}", hit)
+        if not hit:
+            with metrics.timer("view", self.worksheet, ops=len(ops)):
+                self._view = (key, _apply_ops(df, ops, self.schema, self.key_col) if ops else df)
+        return self._view[1]
+
+    def _full_load(self):
+        header, rows = storage.read_all(self.worksheet)
+        if not header:
+            # 空・未作成のシートも読み込み済みにする (以後は画面を待たせず裏で確かめる)
+            return self._swap([], self.df.iloc[0:0], bump=not self.df.empty)
+        key_idx = header.index(self.key_col)
+        rows = [r for r in rows if len(r) > key_idx and r[key_idx]]
+        df = _normalize(_rows_to_frame(header, rows), self.schema)
+        if self.header and _same_rows(self.df, df): return  # 変更なし: インデックスを作り直させない
+        self._swap(header, df)
+
+    def sync(self):
+        self.syncs += 1
+        if not self.header or self.syncs % FULL_SYNC_EVERY == 0: return self._full_load()
+        known_keys = self.df[self.key_col].astype(str)
+        known = dict(zip(known_keys, self.df[UPDATED_AT] if UPDATED_AT in self.df.columns else [""] * len(self.df)))
+        header, keys, changed = storage.read_changes(self.worksheet, self.key_col, known, max(200, len(known) // 2))
+        if header != self.header or changed is None:
+            # ヘッダー変更や大量の変更は丸ごと読み直した方が速い
+            return self._full_load()
+
+        live = set(keys)
+        deleted = [k for k in known if k not in live]
+        if not changed and not deleted: return
+        new_rows = _normalize(_rows_to_frame(header, changed), self.schema)
+        drop = set(deleted) | set(new_rows[self.key_col].astype(str))
+        # カテゴリの値が違う列同士を結合すると文字列に戻るので、型を揃え直す
+        df = _normalize(pd.concat([self.df[~known_keys.isin(drop)], new_rows], ignore_index=True), self.schema)
+        # シート上の並び順に揃える
+        pos = {k: i for i, k in enumerate(keys)}
+        order = df[self.key_col].astype(str).map(pos).fillna(len(keys))
+        self._swap(header, df.iloc[order.to_numpy().argsort(kind="stable")].reset_index(drop=True))
+
+def _apply_ops(df, ops, worksheet, key_col):
+    # ops を DataFrame に適用 (既存行は元の位置のまま更新し、新規行は末尾に追加)
+    if not ops or key_col not in df.columns: return df
+    keys = df[key_col].astype(str)
+    touched = keys.isin(list(ops))
+    found = set(keys[touched])
+    idx, rows = [], []
+    for i, key, row in zip(df.index[touched], keys[touched], df[touched].to_dict('records')):
+        op = ops[key]
+        if op['op'] == 'delete': continue
+        if op['op'] == 'add' and key_col != 'id': rows.append(row)  # 登録済み
+        else: rows.append({**row, **op['data']})
+        idx.append(i)
+    # 変更分だけ先に型を揃えてから結合する (全体を文字列に戻さない)
+    out = pd.concat([df[~touched], _normalize(pd.DataFrame(rows, index=idx), worksheet)]).sort_index() if rows else df[~touched]
+    new_rows = [{key_col: k, **op['data']} for k, op in ops.items() if k not in found and op['op'] in ('add', 'upsert')]
+    out = pd.concat([out, _normalize(pd.DataFrame(new_rows), worksheet)], ignore_index=True) if new_rows else out.reset_index(drop=True)
+    return _normalize(out, worksheet)
+
+@st.cache_resource
+def _get_replicas():
+    return {ws: SheetReplica(ws, key_col, columns) for ws, (key_col, columns) in WORKSHEET_KEYS.items()}
+
+replicas = _get_replicas()
+
+def preload():
+    # まだ一度も読めていないシートをまとめて並列に読む (起動直後・キャッシュが空の時)。
+    # 順に読むとシートの数だけ往復を待つが、並列なら一番遅い1枚分で済む
+    cold = [r for r in replicas.values() if r.header is None and time.time() - r.synced > r.interval]
+    if len(cold) < 2: return
+    with ThreadPoolExecutor(max_workers=len(cold)) as pool:
+        list(pool.map(SheetReplica.refresh, cold))
+
+preload()
+
+def data_version(worksheet):
+    # 画面に見えるデータのバージョン (レプリカ + 未送信の変更)。
+    # 自分の書き込みの送信では進まない (同期で他の端末の変更を取り込んだ時と、変更を積んだ時だけ)
+    if worksheet not in replicas: return (_get_partitions()[worksheet].version, 0)  # 年別アーカイブ (読み取り専用)
+    return (replicas[worksheet].version, write_queue.versions[worksheet])
+
+# 未送信の書き込みを重ねて返す (保存直後でも画面に反映される)
 def get_visits_data():
-    try:
-        df = conn.read(worksheet="visits", ttl=0)
-        df = df.fillna("")
-        df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(0).astype(int)
-        # 新しいカラムの型変換 (ない場合は初期値)
-        if 'rating' not in df.columns: df['rating'] = 0
-        df['rating'] = pd.to_numeric(df['rating'], errors='coerce').fillna(0).astype(int)
-        return df
-    except:
-        # カラム定義を更新
-        return pd.DataFrame(columns=['id', 'store_name', 'visit_date', 'visit_time', 'start_time', 'end_time', 'rating', 'members', 'sv_members', 'count_area', 'notices', 'memo', 'record_memo'])
-
-@st.cache_data(ttl=60)
+    return replicas["visits"].view(*write_queue.overlay("visits"))
+
 def get_stores_data():
-    try:
-        df = conn.read(worksheet="stores", ttl=0)
-        df = df.fillna("")
-        return df
-    except:
-        return pd.DataFrame(columns=['store_name', 'notices', 'memo'])
+    return replicas["stores"].view(*write_queue.overlay("stores"))
+
+def get_members_data():
+    return replicas["visit_members"].view(*write_queue.overlay("visit_members"))
+
+def get_archive_data():
+    return replicas["visit_archive"].view(*write_queue.overlay("visit_archive"))
 
-@st.cache_data(ttl=60)
 def get_employees_list():
-    try:
-        df = conn.read(worksheet="employees", ttl=0)
-        if df.empty or 'name' not in df.columns: return []
-        return sorted(df['name'].dropna().unique().tolist())
-    except: return []
+    return get_index("employees", ("employees",), lambda: sorted(get_roster()))
 
-def clear_all_cache():
-    get_visits_data.clear()
-    get_stores_data.clear()
-    get_employees_list.clear()
+def get_roster():
+    # 従業員名のハッシュセット (バージョンごとに1回だけ作り、全セッションで共有)
+    def build():
+        names = set(replicas["employees"].get()['name'])
+        names |= {k for k, op in write_queue.snapshot("employees").items() if op['op'] != 'delete'}
+        return frozenset(n for n in names if n)
+    return get_index("roster", ("employees",), build)
 
-def add_visit_data(data):
-    try:
-        df = conn.read(worksheet="visits", ttl=0)
-        df = df.fillna("")
-        df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(0).astype(int)
-    except:
-        df = pd.DataFrame(columns=['id', 'store_name', 'visit_date', 'visit_time', 'start_time', 'end_time', 'rating', 'members', 'sv_members', 'count_area', 'notices', 'memo', 'record_memo'])
-
-    new_id = df['id'].max() + 1 if not df.empty and 'id' in df.columns else 1
-    data['id'] = new_id
-    
-    new_row = pd.DataFrame([data])
-    updated_df = pd.concat([df, new_row], ignore_index=True)
-    conn.update(worksheet="visits", data=updated_df)
-    clear_all_cache()
-
-def update_visit_data(record_id, updated_data):
-    with st.spinner("更新中..."):
+# --- 書き込みキュー (write-behind) ---
+# 保存はキューに積むだけで即座に戻り、短い間隔でシートごとにまとめて書き込む。
+# キューはジャーナルファイルにも保存し、プロセスが再起動しても失われない。
+WRITE_JOURNAL_PATH = ".write_journal.json"
+WRITE_FLUSH_DELAY = 3.0
+def _merge_op(old, new):
+    # 同じレコードへの連続した変更を1つにまとめる (None はレコードの消滅)。
+    # base (編集を始めた時点の updated_at) は最初の変更のものを残す
+    if old is None: return new
+    if new['op'] == 'delete':
+        return None if old['op'] == 'add' else new
+    if old['op'] == 'delete': return old if new['op'] == 'update' else new
+    if new['op'] == 'add': return new
+    op = 'upsert' if new['op'] == 'upsert' and old['op'] == 'update' else old['op']
+    merged = {'op': op, 'data': {**old['data'], **new['data']}}
+    base = old.get('base', new.get('base'))
+    if base is not None and op != 'add': merged['base'] = base
+    return merged
+
+class WriteQueue:
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.lock = threading.RLock()
+        self.pending = {ws: {} for ws in WORKSHEET_KEYS}
+        self.inflight = {ws: {} for ws in WORKSHEET_KEYS}
+        self.versions = {ws: 0 for ws in WORKSHEET_KEYS}
+        self.timer = None
+        self.error = None  # 直近の送信の失敗 (画面に表示する。変更は再送される)
+        self.journal_error = None  # ジャーナルの読めなかった部分 (画面に表示する。送信しても消えない)
+        if os.path.exists(journal_path): self._replay()
+
+    def _replay(self):
+        # ジャーナルの変更を積み直す。読めない項目だけを飛ばし、元のファイルは上書きせずに脇へ残す
         try:
-            df = conn.read(worksheet="visits", ttl=0)
-            df = df.fillna("")
-            df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(0).astype(int)
-            
-            if not df.empty and record_id in df['id'].values:
-                idx = df.index[df['id'] == record_id][0]
-                for key, value in updated_data.items():
-                    df.at[idx, key] = value
-                conn.update(worksheet="visits", data=df)
-                clear_all_cache()
-        except: pass
+            with open(self.journal_path, encoding="utf-8") as f: entries = json.load(f)
+            if not isinstance(entries, list): raise ValueError("ジャーナルの形式が正しくありません")
+        except (OSError, ValueError) as e:
+            entries, broken = [], e
+        else:
+            broken = None
+        skipped = 0
+        for e in entries:
+            try:
+                if e['ws'] not in WORKSHEET_KEYS or e['op'] not in ('add', 'update', 'upsert', 'delete') or not isinstance(e['data'], dict):
+                    raise ValueError(e)
+                op = {'op': e['op'], 'data': e['data']}
+                if e.get('base') is not None: op['base'] = str(e['base'])
+                self._merge(e['ws'], str(e['key']), op)
+            except (KeyError, TypeError, ValueError):
+                skipped += 1
+        if broken or skipped:
+            aside = f"{self.journal_path}.{datetime.datetime.now():%Y%m%d%H%M%S}.bad"
+            os.replace(self.journal_path, aside)
+            self._save_journal()  # 読めた分はすぐ書き戻す
+            self.journal_error = f"{broken or f'{skipped}件の変更を読めませんでした'} (元のファイル: {aside})"
+        if any(self.pending.values()): self._schedule(0)
+
+    def _merge(self, ws, key, op):
+        merged = _merge_op(self.pending[ws].get(key), op)
+        if merged is None: self.pending[ws].pop(key, None)
+        else: self.pending[ws][key] = merged
+
+    def _save_journal(self):
+        entries = [
+            {'ws': ws, 'key': key, 'op': op['op'], 'data': op['data'], 'base': op.get('base')}
+            for src in (self.inflight, self.pending) for ws, ops in src.items() for key, op in ops.items()
+        ]
+        tmp = self.journal_path + ".tmp"
+        # json.dump は Python 実装で1件ずつ書くので遅い。dumps (C 実装) でまとめて書く
+        with open(tmp, "w", encoding="utf-8") as f: f.write(json.dumps(entries, ensure_ascii=False))
+        os.replace(tmp, self.journal_path)
+
+    def _schedule(self, delay):
+        if self.timer and self.timer.is_alive(): return
+        self.timer = threading.Timer(delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def enqueue(self, ws, key, op, data, base=None):
+        self.enqueue_many(ws, [(key, op, data)], base)
+
+    def enqueue_many(self, ws, items, base=None):
+        # items: [(キー, op, data)]。ジャーナルの保存は1回だけ。
+        # base: 編集を始めた時点の updated_at。送信時にシートの行と比べ、他の人が先に
+        # 保存していたら、その行を読み直して data の項目だけを当て直す (update / upsert のみ)。
+        # "" は変更時刻が分からない (列が無かった・付いていない行) → 確かめられないので必ず読み直す
+        if not items: return
+        # 差分同期用の変更時刻は積む時に付ける (送信後のシートと画面に重ねた内容を同じにする)
+        stamp = _now_stamp() if ws in STAMPED_WORKSHEETS else None
+        with self.lock:
+            for key, op, data in items:
+                data = {k: to_cell(v) for k, v in data.items()}
+                if stamp and op != 'delete': data[UPDATED_AT] = stamp
+                entry = {'op': op, 'data': data}
+                if base is not None and op in ('update', 'upsert'): entry['base'] = str(to_cell(base))
+                self._merge(ws, str(to_cell(key)), entry)
+            self.versions[ws] += 1
+            self._save_journal()
+            self._schedule(WRITE_FLUSH_DELAY)
+
+    def pending_count(self):
+        with self.lock:
+            return sum(len(ops) for src in (self.inflight, self.pending) for ops in src.values())
+
+    def snapshot(self, ws):
+        # 送信中 + 未送信の変更をまとめた状態
+        with self.lock:
+            ops = dict(self.inflight[ws])
+            for key, op in self.pending[ws].items():
+                merged = _merge_op(ops.get(key), op)
+                if merged is None: ops.pop(key, None)
+                else: ops[key] = merged
+            return ops
+
+    def overlay(self, ws):
+        # (変更, その版) を同時に取る (間に積まれた変更で版だけが先に進まないように)
+        with self.lock:
+            return self.snapshot(ws), self.versions[ws]
+
+    def flush(self):
+        with self.lock:
+            if self.timer is threading.current_thread(): self.timer = None
+            if any(self.inflight.values()): return
+            self.inflight, self.pending = self.pending, {ws: {} for ws in WORKSHEET_KEYS}
+            batch = self.inflight
+        errors = []
+        for ws, ops in batch.items():
+            if not ops: continue
+            key_col, columns = WORKSHEET_KEYS[ws]
+            try:
+                written, header = storage.write_batch(ws, key_col, columns, ops)
+                # 送信中の変更を外しても、同じ内容がスナップショットに入るので見える内容は変わらない
+                replicas[ws].patch(written, header, as_queued=written == ops)
+                batch[ws] = {}
+            except Exception as e:
+                # 途中まで書けている可能性があるので、このシートだけ読み直させる
+                replicas[ws].invalidate()
+                errors.append(e)
+        failed = bool(errors)
+        self.error = errors[-1] if errors else None
+        with self.lock:
+            # 失敗した分は後から積まれた変更の前に戻して再送する
+            remaining, self.inflight = self.inflight, {ws: {} for ws in WORKSHEET_KEYS}
+            later, self.pending = self.pending, remaining
+            for ws, ops in later.items():
+                for key, op in ops.items(): self._merge(ws, key, op)
+            self._save_journal()
+            if failed or any(self.pending.values()): self._schedule(WRITE_FLUSH_DELAY * (5 if failed else 1))
+
+@st.cache_resource
+def _get_write_queue():
+    return WriteQueue(WRITE_JOURNAL_PATH)
+
+write_queue = _get_write_queue()
+
+def flush_writes():
+    # キューに溜まった書き込みを今すぐ送る
+    write_queue.flush()
+
+def next_visit_id():
+    # 端末ごとに予約した id ブロックから払い出す (同時に保存しても重複しない)
+    return storage.allocate_id("visits")
+
+def _changed_since(data, base):
+    # 編集画面を開いた時点 (base) から変えた項目だけを残す。
+    # 他の人が同時に別の項目を変えていても上書きせずに済む (同じ項目は後から保存した方が優先)。
+    # base[UPDATED_AT] は送信時の競合確認に使う (WriteQueue.enqueue_many)
+    if base is None: return data
+    return {k: v for k, v in data.items() if str(to_cell(v)) != str(to_cell(base.get(k, "")))}
+
+def _sync_visit_members(visit_id, sv_text, mem_text, prev=None):
+    # visit_members は変更前との差分だけをキューに積む。
+    # 変更前の行は変更前の記録 (prev) の文字列から決まるので、インデックスは引かない
+    new = _member_rows(visit_id, sv_text, mem_text)
+    old = _member_rows(visit_id, prev.get('sv_members', ''), prev.get('members', '')) if prev else {}
+    items = [(k, 'delete', {}) for k in old if k not in new] + [(k, 'add', row) for k, row in new.items() if k not in old]
+    write_queue.enqueue_many("visit_members", items)
+
+def _visit_row(record_id):
+    row = get_visit_repo().row(record_id)
+    return row.to_dict() if row is not None else None
+
+def add_visit_data(data):
+    before = data_version("visits")
+    data['id'] = next_visit_id()
+    _sync_visit_members(data['id'], data.get('sv_members', ''), data.get('members', ''))
+    write_queue.enqueue("visits", data['id'], 'add', data)
+    patch_store_summary(before, None, data)
+    patch_search_index("visits", before, None, data)
+
+def update_visit_data(record_id, updated_data, base=None):
+    updated_data = _changed_since(updated_data, base)
+    if not updated_data: return
+    before = data_version("visits")
+    prev = _visit_row(record_id)
+    if 'sv_members' in updated_data or 'members' in updated_data:
+        p = prev or {}
+        _sync_visit_members(record_id, updated_data.get('sv_members', p.get('sv_members', '')), updated_data.get('members', p.get('members', '')), prev)
+    write_queue.enqueue("visits", record_id, 'update', updated_data, base=base.get(UPDATED_AT, "") if base is not None else None)
+    if prev:
+        patch_store_summary(before, prev, {**prev, **updated_data})
+        patch_search_index("visits", before, prev, {**prev, **updated_data})
 
 def delete_visit_data(record_id):
-    with st.spinner("削除中..."):
-        df = conn.read(worksheet="visits", ttl=0)
-        df = df.fillna("")
-        df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(0).astype(int)
-        if not df.empty:
-            updated_df = df[df['id'] != record_id]
-            conn.update(worksheet="visits", data=updated_df)
-            clear_all_cache()
+    before = data_version("visits")
+    prev = _visit_row(record_id)
+    if prev: write_queue.enqueue_many("visit_members", [(k, 'delete', {}) for k in _member_rows(record_id, prev['sv_members'], prev['members'])])
+    write_queue.enqueue("visits", record_id, 'delete', {})
+    if prev:
+        patch_store_summary(before, prev, None)
+        patch_search_index("visits", before, prev, None)
 
 def register_new_store(store_name, notices, memo):
-    try:
-        df = conn.read(worksheet="stores", ttl=0)
-        df = df.fillna("")
-    except:
-        df = pd.DataFrame(columns=['store_name', 'notices', 'memo'])
-        
-    if not df.empty and store_name in df['store_name'].values: return False
-    new_row = pd.DataFrame([{"store_name": store_name, "notices": notices, "memo": memo}])
-    updated_df = pd.concat([df, new_row], ignore_index=True)
-    conn.update(worksheet="stores", data=updated_df)
-    clear_all_cache()
+    if store_name in get_store_repo(): return False
+    before = data_version("stores")
+    row = {"store_name": store_name, "notices": notices, "memo": memo}
+    write_queue.enqueue("stores", store_name, 'add', row)
+    patch_search_index("stores", before, None, row)
     return True
 
-def update_store_info(store_name, new_notices, new_memo):
-    with st.spinner("更新中..."):
-        try:
-            df = conn.read(worksheet="stores", ttl=0)
-            df = df.fillna("")
-        except: return
-
-        if not df.empty and store_name in df['store_name'].values:
-            df.loc[df['store_name'] == store_name, 'notices'] = new_notices
-            df.loc[df['store_name'] == store_name, 'memo'] = new_memo
-            conn.update(worksheet="stores", data=df)
-            clear_all_cache()
-        else:
-            register_new_store(store_name, new_notices, new_memo)
+def update_store_info(store_name, new_notices, new_memo, base=None):
+    # シートに無ければ送信時に新規行として追加される
+    data = _changed_since({"notices": new_notices, "memo": new_memo}, base)
+    if not data: return
+    before = data_version("stores")
+    prev = get_store_repo().row(store_name)
+    prev = prev.to_dict() if prev is not None else None
+    write_queue.enqueue("stores", store_name, 'upsert', data, base=base.get(UPDATED_AT, "") if base is not None else None)
+    patch_search_index("stores", before, prev, {**(prev or {"store_name": store_name}), **data})
 
 def check_and_add_employees(names_list):
+    # 保存1回につき1度だけ呼ぶ。未登録の名前だけをまとめて1回で追記する
     if not names_list: return 0
-    try:
-        df = conn.read(worksheet="employees", ttl=0)
-    except: df = pd.DataFrame(columns=['name'])
-    curr = df['name'].tolist() if not df.empty and 'name' in df.columns else []
-    news = [n for n in names_list if n not in curr]
-    if news:
-        new_rows = pd.DataFrame([{'name': n} for n in news])
-        updated_df = pd.concat([df, new_rows], ignore_index=True)
-        conn.update(worksheet="employees", data=updated_df)
-        clear_all_cache()
-        return len(news)
-    return 0
+    roster = get_roster()
+    news = list(dict.fromkeys(n for n in names_list if n not in roster))
+    write_queue.enqueue_many("employees", [(n, 'add', {'name': n}) for n in news])
+    return len(news)
+
+# --- インデックス (データのバージョンごとに1回だけ構築) ---
+@st.cache_resource
+def _index_cache():
+    return {}
+
+@st.cache_resource
+def _index_lock():
+    # キャッシュへの登録と差分の適用を直列にする (apply の中で別のインデックスを引くので RLock)
+    return threading.RLock()
+
+def get_index(name, worksheets, build, extra=()):
+    # 対象シートのバージョンが変わった時だけ build() を呼び直す (全セッションで共有)。
+    # extra: バージョンに加える値 (シートの一部の内容だけに依存する時)
+    version = tuple(data_version(ws) for ws in worksheets) + tuple(extra)
+    cache = _index_cache()
+    hit = cache.get(name)
+    metrics.hit(f"index:{name}", bool(hit and hit[0] == version))
+    if hit and hit[0] == version: return hit[1]
+    with metrics.timer("index", name): index = build()
+    # 作っている間に別のセッションが変更を積んでいたら、どちらの版の内容か分からないので登録しない
+    # (古い版で登録すると、その変更を patch_index でもう一度当ててしまう)
+    with _index_lock():
+        if tuple(data_version(ws) for ws in worksheets) + tuple(extra) == version: cache[name] = (version, index)
+    return index
+
+def patch_index(name, worksheets, worksheet, before, apply):
+    # worksheet の版が直前の書き込み1回分だけ進んだのなら、作り直さずに apply(index) で差分を当てる。
+    # それ以外 (他の端末の変更や同期が挟まった) は何もせず、次の get_index で作り直させる
+    with _index_lock():
+        cache = _index_cache()
+        hit = cache.get(name)
+        version = tuple(data_version(ws) for ws in worksheets)
+        i = worksheets.index(worksheet)
+        after = version[i]
+        if hit and hit[0] == version[:i] + (before,) + version[i + 1:] and after == (before[0], before[1] + 1):
+            apply(hit[1])
+            cache[name] = (version, hit[1])
+
+class DateIndex:
+    def __init__(self, df):
+        self.df = df
+        self.months = {}  # (年, 月) -> {日: [店舗名, ...]}
+        self.days = {}    # date -> 行位置の配列
+        if df.empty: return
+        dates = df['visit_date']
+        valid = dates.notna().to_numpy()
+        sub = pd.DataFrame({
+            'y': dates.dt.year, 'm': dates.dt.month, 'd': dates.dt.day,
+            'store': df['store_name'].astype(str), 'pos': range(len(df)),
+        })[valid]
+        grouped = sub.groupby(['y', 'm', 'd'], sort=False).agg({'store': list, 'pos': list})
+        for (y, m, d), stores, pos in zip(grouped.index, grouped['store'], grouped['pos']):
+            self.months.setdefault((int(y), int(m)), {})[int(d)] = stores
+            self.days[datetime.date(int(y), int(m), int(d))] = pos
+
+    def month(self, year, month):
+        return self.months.get((year, month), {})
+
+    def visits_on(self, date):
+        return self.df.iloc[self.days.get(date, [])]
+
+    def count_before(self, year):
+        # year より前の記録の件数 (日付のある記録のみ)
+        return sum(len(pos) for date, pos in self.days.items() if date.year < year)
+
+def get_date_index():
+    return get_index("date", ("visits",), lambda: DateIndex(get_visits_data()))
+
+class KeyIndex:
+    # 主キー -> 行位置 (ハッシュ)。同じキーが複数あれば先頭の行
+    def __init__(self, df, key_col):
+        self.df = df
+        keys = df[key_col].tolist() if key_col in df.columns else []
+        self.by_key = dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))
+
+    def __contains__(self, key):
+        return key in self.by_key
+
+    def row(self, key):
+        i = self.by_key.get(key)
+        return self.df.iloc[i] if i is not None else None
+
+class VisitRepository(KeyIndex):
+    # 記録の索引: id -> 行位置、店舗 -> 行位置 (日付の昇順、日付なしは末尾)。
+    # 画面・更新処理はここから引き、記録一覧を毎回なめない
+    def __init__(self, df):
+        super().__init__(df, 'id')
+        self.dates = df['visit_date'].to_numpy()
+        order = np.argsort(self.dates, kind='stable')
+        codes, names = pd.factorize(df['store_name'].astype(str).to_numpy()[order])
+        grouped = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[grouped], np.arange(len(names) + 1))
+        self.by_store = {s: order[grouped[bounds[i]:bounds[i + 1]]] for i, s in enumerate(names)}
+
+    def store_visits(self, store, d_from=None, d_to=None):
+        # 店舗の記録を新しい順に。期間を指定した時は日付を二分探索して切り出す (日付なしは除く)
+        pos = self.by_store.get(store, np.array([], dtype=np.int64))
+        dates = self.dates[pos]
+        dated = np.searchsorted(dates, np.datetime64('NaT'), 'left')
+        if not (d_from or d_to): return self.df.iloc[np.concatenate([pos[:dated][::-1], pos[dated:]])]
+        lo = np.searchsorted(dates, np.datetime64(d_from), 'left') if d_from else 0
+        hi = np.searchsorted(dates, np.datetime64(d_to), 'right') if d_to else dated
+        return self.df.iloc[pos[lo:hi][::-1]]
+
+def get_visit_repo():
+    return get_index("visit_repo", ("visits",), lambda: VisitRepository(get_visits_data()))
+
+def get_store_repo():
+    return get_index("store_repo", ("stores",), lambda: KeyIndex(get_stores_data(), 'store_name'))
+
+def _rating(v):
+    v = pd.to_numeric(v, errors='coerce')
+    return int(v) if pd.notna(v) and v > 0 else 0
+
+def _empty_stats():
+    return {'count': 0, 'rating_sum': 0, 'rating_count': 0, 'last_date': "", 'last_sv': "", 'last_members': ""}
+
+def _add_stats(s, other):
+    # 集計 other を s に足し込む (最終訪問は新しい方)
+    s['count'] += other['count']
+    s['rating_sum'] += other['rating_sum']
+    s['rating_count'] += other['rating_count']
+    if other['last_date'] > s['last_date']:
+        s.update(last_date=other['last_date'], last_sv=other['last_sv'], last_members=other['last_members'])
+
+class StoreSummary:
+    # 店舗ごとの集計: 記録数・評価の合計/件数 (0 は未評価)・最終訪問日とその時のメンバー。
+    # 記録の追加・更新・削除では apply() で差分だけを反映する。
+    # archived には年別アーカイブの合計 (マニフェストから) が入り、get() で足し合わせる
+    def __init__(self, df):
+        self.stats = {}
+        self.archived = {}
+        if df.empty: return
+        sub = pd.DataFrame({
+            'store': df['store_name'], 'visit_date': df['visit_date'].dt.strftime("%Y-%m-%d").fillna(""),
+            'rated': df['rating'].where(df['rating'] > 0), 'sv_members': df['sv_members'], 'members': df['members'],
+        })
+        agg = sub.groupby('store', sort=False, observed=True).agg(count=('visit_date', 'size'), rating_sum=('rated', 'sum'), rating_count=('rated', 'count'))
+        # 同じ日付なら後ろの行を最終訪問とみなす
+        last = sub.sort_values('visit_date', kind='stable').groupby('store', sort=False, observed=True).tail(1)
+        last = {s: (d, sv, m) for s, d, sv, m in zip(last['store'], last['visit_date'], last['sv_members'], last['members'])}
+        for store, count, r_sum, r_cnt in zip(agg.index, agg['count'], agg['rating_sum'], agg['rating_count']):
+            d, sv, m = last[store]
+            self.stats[store] = {'count': int(count), 'rating_sum': int(r_sum), 'rating_count': int(r_cnt),
+                                 'last_date': d, 'last_sv': sv, 'last_members': m}
+
+    def get(self, store):
+        if store not in self.archived: return self.stats.get(store, _empty_stats())
+        s = dict(self.stats.get(store, _empty_stats()))
+        _add_stats(s, self.archived[store])
+        return s
+
+    def avg_rating(self, store):
+        s = self.get(store)
+        return s['rating_sum'] / s['rating_count'] if s['rating_count'] else 0.0
+
+    def _add(self, row):
+        s = self.stats.setdefault(row.get('store_name', ''), _empty_stats())
+        s['count'] += 1
+        r = _rating(row.get('rating'))
+        if r:
+            s['rating_sum'] += r
+            s['rating_count'] += 1
+        date = to_cell(row.get('visit_date', ''))
+        if s['count'] == 1 or date >= s['last_date']:
+            s.update(last_date=date, last_sv=row.get('sv_members', ''), last_members=row.get('members', ''))
+
+    def _remove(self, row):
+        # 最終訪問の記録を消した場合は True (その店舗だけ数え直す)
+        s = self.stats.get(row.get('store_name', ''))
+        if not s: return False
+        s['count'] -= 1
+        r = _rating(row.get('rating'))
+        if r:
+            s['rating_sum'] -= r
+            s['rating_count'] -= 1
+        return to_cell(row.get('visit_date', '')) == s['last_date']
+
+    def apply(self, old, new, repo):
+        # old/new: 変更前後の記録 (追加なら old=None、削除なら new=None)。
+        # repo は変更後の記録の索引を返す関数 (数え直しが要る時だけ作る)
+        recount = old is not None and self._remove(old)
+        if new is not None: self._add(new)
+        if recount:
+            store = old.get('store_name', '')
+            self.stats.pop(store, None)
+            self.stats.update(StoreSummary(repo().store_visits(store)).stats)
+
+def get_store_summary():
+    summary = get_index("store_summary", ("visits",), lambda: StoreSummary(get_visits_data()))
+    summary.archived = get_archive_index()[1]
+    return summary
+
+def patch_store_summary(before, old, new):
+    patch_index("store_summary", ("visits",), "visits", before, lambda summary: summary.apply(old, new, get_visit_repo))
+
+# 検索対象: 検索グループ -> [(シート, カラム)]。店舗名の一致は重み付けして上位に並べる
+SEARCH_FIELDS = {
+    "store": [("stores", "store_name")],
+    "member": [("visits", "members"), ("visits", "sv_members")],
+    "memo": [("stores", "notices"), ("stores", "memo"), ("visits", "record_memo"), ("visits", "notices"), ("visits", "memo")],
+}
+SEARCH_WEIGHTS = {"store": 10, "member": 1, "memo": 1}
+
+def _norm_text(s):
+    return unicodedata.normalize("NFKC", str(s)).lower()
+
+def _grams(text):
+    # 1文字 + 2文字 (bigram)。日本語は単語の区切りが無いので文字 n-gram で索引する
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+class SearchIndex:
+    # 記録・店舗の追加・更新・削除では apply() でその行の分だけを差し替える。
+    # 検索中の他のセッションと共有しているので、変える件数表・本文リストは複製してから差し替える
+    def __init__(self, stores_df, visits_df):
+        frames = {"stores": stores_df, "visits": visits_df}
+        self.postings = {g: defaultdict(Counter) for g in SEARCH_FIELDS}  # gram -> {店舗名: 件数}
+        self.texts = {g: defaultdict(list) for g in SEARCH_FIELDS}        # 店舗名 -> [本文] (照合用)
+        for group, fields in SEARCH_FIELDS.items():
+            for ws, col in fields:
+                df = frames[ws]
+                if df.empty or col not in df.columns: continue
+                for store, value in zip(df['store_name'], df[col]):
+                    text = _norm_text(value)
+                    if not text: continue
+                    self.texts[group][store].append(text)
+                    for gram in _grams(text): self.postings[group][gram][store] += 1
+
+    def apply(self, ws, old, new):
+        # シート ws の1行の変更 (追加なら old=None、削除なら new=None)
+        texts, deltas = {}, defaultdict(Counter)  # (グループ, 店舗名) -> 本文, (グループ, gram) -> {店舗名: 増減}
+        for row, sign in ((old, -1), (new, 1)):
+            if row is None: continue
+            store = row.get('store_name', '')
+            for group, fields in SEARCH_FIELDS.items():
+                for sheet, col in fields:
+                    text = _norm_text(row.get(col, '')) if sheet == ws else ""
+                    if not text: continue
+                    if (group, store) not in texts: texts[group, store] = list(self.texts[group].get(store, ()))
+                    if sign > 0: texts[group, store].append(text)
+                    elif text in texts[group, store]: texts[group, store].remove(text)
+                    else: continue
+                    for gram in _grams(text): deltas[group, gram][store] += sign
+        for (group, store), t in texts.items():
+            if t: self.texts[group][store] = t
+            else: self.texts[group].pop(store, None)
+        for (group, gram), delta in deltas.items():
+            counts = Counter(self.postings[group].get(gram, ()))
+            counts.update(delta)
+            counts = Counter({s: n for s, n in counts.items() if n > 0})
+            if counts: self.postings[group][gram] = counts
+            else: self.postings[group].pop(gram, None)
+
+    def _match(self, term, group):
+        # 語のすべての n-gram を含む店舗に絞り、3文字以上は本文で確認する
+        postings = self.postings[group]
+        grams = _grams(term) if len(term) < 2 else {term[i:i + 2] for i in range(len(term) - 1)}
+        lists = sorted((postings.get(g, {}) for g in grams), key=len)
+        if not lists or not lists[0]: return {}
+        hits = {}
+        for store in lists[0]:
+            if all(store in p for p in lists[1:]):
+                if len(term) > 2 and not any(term in t for t in self.texts[group].get(store, ())): continue
+                hits[store] = min(p[store] for p in lists)
+        return hits
+
+    def search(self, query, groups):
+        # スペース区切りの語はすべて含む (AND)。スコア順 → 店舗名順で返す
+        terms = [_norm_text(t) for t in query.split() if t.strip()]
+        scores = None
+        for term in terms:
+            term_scores = Counter()
+            for group in groups:
+                for store, n in self._match(term, group).items():
+                    term_scores[store] += n * SEARCH_WEIGHTS[group]
+            scores = term_scores if scores is None else Counter({s: scores[s] + n for s, n in term_scores.items() if s in scores})
+            if not scores: return []
+        return [s for s, _ in sorted((scores or {}).items(), key=lambda x: (-x[1], x[0]))]
+
+def get_search_index():
+    return get_index("search", ("visits", "stores"), lambda: SearchIndex(get_stores_data(), get_visits_data()))
+
+def patch_search_index(ws, before, old, new):
+    patch_index("search", ("visits", "stores"), ws, before, lambda index: index.apply(ws, old, new))
+
+def _split_names(text):
+    return [n.strip() for n in str(text).split(',') if n.strip()]
+
+def _member_rows(visit_id, sv_text, mem_text):
+    # visit_members の行 {member_key: {...}} を作る
+    rows = {}
+    for role, text in (("sv", sv_text), ("member", mem_text)):
+        for person in _split_names(text):
+            rows[f"{visit_id}|{role}|{person}"] = {'visit_id': visit_id, 'person': person, 'role': role}
+    return rows
+
+class MemberIndex:
+    # visit_members を (記録, 人, 役割) の配列で持つ。人名はカテゴリ番号に圧縮する
+    def __init__(self, members_df, visits_df):
+        live = visits_df['id'] if not visits_df.empty else pd.Series([], dtype=np.int64)
+        rows = members_df.reindex(columns=MEMBER_COLUMNS)
+        rows = rows[rows['visit_id'].isin(live) & (rows['person'].fillna("") != "")].drop_duplicates('member_key', keep='last')
+        # 文字列カラムしか無い古い記録は文字列から補い、移行用に書き込む
+        self.migration = {}
+        if not visits_df.empty:
+            old = visits_df[~visits_df['id'].isin(rows['visit_id']) & ((visits_df['sv_members'] != "") | (visits_df['members'] != ""))]
+            for vid, sv, mem in zip(old['id'], old['sv_members'], old['members']): self.migration.update(_member_rows(vid, sv, mem))
+        if self.migration:
+            rows = pd.concat([rows, pd.DataFrame([{'member_key': k, **r} for k, r in self.migration.items()])], ignore_index=True)
+
+        self.visit_ids = rows['visit_id'].to_numpy(dtype=np.int64)
+        persons = pd.Categorical(rows['person'])
+        self.people = list(persons.categories)
+        self.codes = persons.codes.astype(np.int32)
+        self.is_sv = (rows['role'] == 'sv').to_numpy()
+        # 同じ記録で SV とメンバーを兼ねていても1件と数える
+        self.first = ~pd.DataFrame({'v': self.visit_ids, 'c': self.codes}).duplicated().to_numpy()
+        # 記録ごとの年月 (yyyymm)
+        dates = visits_df['visit_date']
+        ym = (dates.dt.year * 100 + dates.dt.month).fillna(0).astype(int)
+        ym = pd.Series(ym.to_numpy(), index=visits_df['id'].to_numpy())
+        ym = ym[~ym.index.duplicated()]
+        self.ym = pd.Series(self.visit_ids).map(ym).fillna(0).astype(int).to_numpy()
+
+        order = np.argsort(self.codes, kind='stable')
+        bounds = np.searchsorted(self.codes[order], np.arange(len(self.people) + 1))
+        self.by_person = {p: order[bounds[i]:bounds[i + 1]] for i, p in enumerate(self.people)}
+        # 記録 id の昇順 (記録ごとの行は二分探索で切り出す)
+        self.visit_order = np.argsort(self.visit_ids, kind='stable')
+        self.sorted_visits = self.visit_ids[self.visit_order]
+
+    def members_of(self, visit_id, role):
+        lo, hi = np.searchsorted(self.sorted_visits, int(visit_id), 'left'), np.searchsorted(self.sorted_visits, int(visit_id), 'right')
+        return [self.people[self.codes[i]] for i in self.visit_order[lo:hi] if self.is_sv[i] == (role == 'sv')]
+
+    def visit_count(self, person, year=None, month=None, role=None):
+        idx = self.by_person.get(person, np.array([], dtype=np.int64))
+        mask = self.first[idx] if role is None else (self.is_sv[idx] == (role == 'sv'))
+        if year: mask &= self.ym[idx] == year * 100 + month
+        return int(mask.sum())
+
+    def month_counts(self, year, month):
+        # 人ごとの訪問件数 (多い順)
+        mask = self.first & (self.ym == year * 100 + month)
+        counts = np.bincount(self.codes[mask], minlength=len(self.people))
+        s = pd.Series(counts, index=self.people, dtype=int)
+        return s[s > 0].sort_values(ascending=False)
+
+def get_visit_dates_key():
+    # 記録の (id, 日付) の指紋。メモ・評価などの変更では変わらない
+    def build():
+        df = get_visits_data()
+        if df.empty: return (0, 0)
+        return (len(df), int(pd.util.hash_pandas_object(df[['id', 'visit_date']], index=False).sum()))
+    return get_index("visit_dates", ("visits",), build)
+
+def get_member_index():
+    # visit_members と記録の日付だけに依存させる (記録の他の項目の変更では作り直さない)
+    index = get_index("members", ("visit_members",), lambda: MemberIndex(get_members_data(), get_visits_data()), extra=get_visit_dates_key())
+    if index.migration:
+        write_queue.enqueue_many("visit_members", [(k, 'add', row) for k, row in index.migration.items()])
+        index.migration = {}
+    return index
+
+# --- 記録の年別アーカイブ ---
+# 古い年の記録は「visits_{年}」シートへ移し、visits シートには直近の記録だけを残す。
+# visit_archive (マニフェスト) に 年×店舗 ごとの集計を持つので、店舗の件数・評価や
+# どの年にその店舗の記録があるかはアーカイブを読まずに分かる。
+# アーカイブ本体は画面が必要とした年だけを読み込む (閲覧のみ)。
+ARCHIVE_KEEP_YEARS = 2         # 今年と昨年は visits シートに残す
+ARCHIVE_SYNC_INTERVAL = 3600   # アーカイブはほぼ変わらないので同期はまれでよい
+
+def _archive_sheet(year):
+    return f"visits_{year}"
+
+@st.cache_resource
+def _get_partitions():
+    return {}
+
+def _partition(year, parts):
+    ws = _archive_sheet(year)
+    if ws not in parts: parts.setdefault(ws, SheetReplica(ws, "id", VISIT_COLUMNS, schema="visits", interval=ARCHIVE_SYNC_INTERVAL))
+    return parts[ws]
+
+def visits_partition(year):
+    # その年のアーカイブ (初めて必要になった時に読み込む)
+    return _partition(year, _get_partitions()).get()
+
+def _build_archive_index():
+    # マニフェストから ({年: {店舗名}}, {店舗名: アーカイブ分の合計}) を作る
+    years, totals = defaultdict(set), {}
+    for row in get_archive_data().to_dict('records'):
+        year = int(pd.to_numeric(row['year'], errors='coerce') or 0)
+        if not year: continue
+        years[year].add(row['store_name'])
+        part = {c: int(pd.to_numeric(row[c], errors='coerce') or 0) for c in ('count', 'rating_sum', 'rating_count')}
+        part.update(last_date=row['last_date'], last_sv=row['last_sv'], last_members=row['last_members'])
+        _add_stats(totals.setdefault(row['store_name'], _empty_stats()), part)
+    return dict(years), totals
+
+def get_archive_index():
+    return get_index("archive", ("visit_archive",), _build_archive_index)
+
+def archived_years():
+    return get_archive_index()[0].keys()
+
+def get_partition_index(year, kind):
+    # アーカイブ年のインデックス (kind: "date" / "repo" / "members")。アーカイブのバージョンごとに1回だけ構築
+    visits_partition(year)
+    ws = _archive_sheet(year)
+    if kind == "date":
+        return get_index(f"date_{ws}", (ws,), lambda: DateIndex(visits_partition(year)))
+    if kind == "repo":
+        return get_index(f"repo_{ws}", (ws,), lambda: VisitRepository(visits_partition(year)))
+    def build():
+        # 文字列カラムから人を数える (アーカイブの分は visit_members には書き込まない)
+        index = MemberIndex(pd.DataFrame(columns=MEMBER_COLUMNS), visits_partition(year))
+        index.migration = {}
+        return index
+    return get_index(f"members_{ws}", (ws,), build)
+
+def month_visits_map(year, month):
+    # カレンダー用 {日: [店舗名]}。アーカイブ済みの年はその年のアーカイブも合わせる
+    visits_map = get_date_index().month(year, month)
+    if year not in archived_years(): return visits_map
+    merged = {d: list(stores) for d, stores in get_partition_index(year, "date").month(year, month).items()}
+    for d, stores in visits_map.items(): merged.setdefault(d, []).extend(stores)
+    return merged
+
+def visits_on_date(date):
+    day = get_date_index().visits_on(date)
+    if date.year not in archived_years(): return day
+    return pd.concat([get_partition_index(date.year, "date").visits_on(date), day], ignore_index=True)
+
+def month_member_counts(year, month):
+    counts = get_member_index().month_counts(year, month)
+    if year not in archived_years(): return counts
+    counts = counts.add(get_partition_index(year, "members").month_counts(year, month), fill_value=0)
+    return counts.astype(int).sort_values(ascending=False)
+
+def archived_store_visits(store, years, d_from=None, d_to=None):
+    # 指定した年のうち、マニフェスト上その店舗の記録がある年のアーカイブだけを読む
+    year_stores = get_archive_index()[0]
+    frames = [get_partition_index(y, "repo").store_visits(store, d_from, d_to) for y in sorted(years) if store in year_stores.get(y, ())]
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+def archive_old_visits(keep_from_year):
+    # keep_from_year より前の記録を年ごとのシートへ移す。
+    # アーカイブへの書き込みはその場で行い、書けた年の分だけマニフェストと visits 側の削除をキューに積む
+    # (途中の年で失敗しても、それまでに移した年はマニフェストに載っている)
+    df = get_visits_data()
+    years = df['visit_date'].dt.year
+    moved = 0
+    for year in sorted(set(years[years < keep_from_year].astype(int))):
+        part = df[years == year]
+        ws = _archive_sheet(year)
+        ops = {str(vid): {'op': 'add', 'data': {c: to_cell(v) for c, v in row.items() if c != 'id'}}
+               for vid, row in zip(part['id'], part.to_dict('records'))}
+        storage.write_batch(ws, "id", VISIT_COLUMNS, ops)
+        if ws in _get_partitions():
+            # 書いた内容で数え直すので、裏の同期を待たずにここで読み直す
+            _get_partitions()[ws].invalidate()
+            _get_partitions()[ws].refresh()
+        # マニフェストはその年のアーカイブ全体から数え直す (同じ年を2回アーカイブしても正しい)。
+        # 削除より先に積む (間で止まっても記録が数えられなくなることはない)
+        stats = StoreSummary(visits_partition(year)).stats
+        write_queue.enqueue_many("visit_archive", [(f"{year}|{store}", 'upsert', {'year': year, 'store_name': store, **s}) for store, s in stats.items()])
+        # 移した記録の visit_members も消す (アーカイブの人数は文字列カラムから数える)
+        member_keys = [k for vid, sv, mem in zip(part['id'], part['sv_members'], part['members']) for k in _member_rows(vid, sv, mem)]
+        write_queue.enqueue_many("visit_members", [(k, 'delete', {}) for k in member_keys])
+        write_queue.enqueue_many("visits", [(vid, 'delete', {}) for vid in part['id']])
+        moved += len(part)
+    return moved
+
+# --- 一括取り込み・書き出し ---
+# 紙/Excel の過去の記録を CSV・Excel からまとめて取り込む。
+# 検証は列ごとにまとめて行い、取り込みはシートごとに1回の書き込みで済ませる。
+IMPORT_TARGETS = {"visits": "記録", "stores": "店舗", "employees": "従業員"}
+IMPORT_DEDUP_COLUMNS = ['store_name', 'visit_date', 'start_time', 'end_time', 'sv_members', 'members']
+EXPORT_CHUNK_ROWS = 5000
+
+def read_upload(file):
+    # すべて文字列として読む。CSV は UTF-8 (BOM 付き可) か Shift_JIS
+    if file.name.lower().endswith(('.xlsx', '.xls')):
+        df = pd.read_excel(file, dtype=str)  # openpyxl が必要
+    else:
+        try:
+            df = pd.read_csv(file, dtype=str, encoding="utf-8-sig")
+        except UnicodeDecodeError:
+            file.seek(0)
+            df = pd.read_csv(file, dtype=str, encoding="cp932")
+    df.columns = [str(c).strip() for c in df.columns]
+    return df.fillna("").astype(str).apply(lambda s: s.str.strip())
+
+def _clock(s):
+    # "9:00" / "09:00:00" (Excel) -> "09:00"。読めなければ NaN
+    t = pd.to_datetime(s, format="%H:%M", errors='coerce').fillna(pd.to_datetime(s, format="%H:%M:%S", errors='coerce'))
+    return t.dt.strftime("%H:%M")
+
+def _cell_frame(df, columns):
+    # 型付きの DataFrame をシートと同じ文字列表記に戻す (列ごとにまとめて変換)
+    out = pd.DataFrame(index=df.index)
+    for c in columns:
+        s = df[c] if c in df.columns else pd.Series("", index=df.index)
+        if pd.api.types.is_datetime64_any_dtype(s): s = s.dt.strftime("%Y-%m-%d")
+        elif pd.api.types.is_timedelta64_dtype(s): s = (pd.Timestamp(0) + s).dt.strftime("%H:%M")
+        out[c] = s.astype(object).where(s.notna(), "").astype(str)
+    return out
+
+def prepare_import(target, df):
+    # 取り込み前の検証。戻り値: {'rows': 取り込む行, 'errors': 理由付きの不正な行, 'skipped': 重複件数, 'stores': 新しい店舗, 'employees': 新しい従業員}
+    key_col, columns = WORKSHEET_KEYS[target]
+    df = df.reindex(columns=[c for c in columns if c != 'id'], fill_value="")
+    reasons = pd.Series("", index=df.index)
+    def flag(mask, msg):
+        reasons[mask] = reasons[mask] + msg + " "
+    flag(df['store_name' if target == "visits" else key_col] == "", "名前が空")
+    result = {'stores': [], 'employees': []}
+    if target == "visits":
+        dates = pd.to_datetime(df['visit_date'].str.replace('/', '-'), format="mixed", errors='coerce')
+        flag(dates.isna(), "日付")
+        df['visit_date'] = dates.dt.strftime("%Y-%m-%d").fillna("")
+        for c in ('start_time', 'end_time'):
+            t = _clock(df[c])
+            flag((df[c] != "") & t.isna(), "時間")
+            df[c] = t.fillna("")
+        rating = pd.to_numeric(df['rating'].replace("", "0"), errors='coerce')
+        flag(~rating.between(0, 5) | (rating % 1 != 0), "評価(0〜5)")
+        df['rating'] = rating.fillna(0).astype(int)
+        for c in ('sv_members', 'members'):
+            df[c] = df[c].str.replace('、', ',').map(lambda t: ", ".join(_split_names(t)))
+    ok = df[reasons == ""]
+    result['errors'] = df[reasons != ""].assign(エラー=reasons[reasons != ""].str.strip())
+    # ファイル内の重複と登録済みのものを除く
+    if target == "visits":
+        ok = ok.drop_duplicates(subset=IMPORT_DEDUP_COLUMNS)
+        existing = _cell_frame(get_visits_data(), IMPORT_DEDUP_COLUMNS).drop_duplicates()
+        known = ok[IMPORT_DEDUP_COLUMNS].merge(existing, how='left', indicator=True)['_merge'].eq('both').to_numpy()
+    else:
+        ok = ok.drop_duplicates(subset=[key_col])
+        current = get_stores_data()['store_name'] if target == "stores" else pd.Series(sorted(get_roster()), dtype=str)
+        known = ok[key_col].isin(set(current)).to_numpy()
+    result['rows'], result['skipped'] = ok[~known], int(known.sum()) + len(df) - len(result['errors']) - len(ok)
+    if target == "visits":
+        rows = result['rows']
+        result['stores'] = sorted(set(rows['store_name']) - set(get_stores_data()['store_name']))
+        names = pd.concat([rows['sv_members'], rows['members']]).str.split(',').explode().str.strip()
+        roster = get_roster()
+        result['employees'] = sorted(n for n in set(names.dropna()) if n and n not in roster)
+    return result
+
+def commit_import(target, prepared):
+    # シートごとに enqueue_many 1回 → 送信時もシートごとに1回の書き込みになる
+    rows = prepared['rows']
+    if target == "visits":
+        ids = storage.allocate_ids("visits", len(rows))
+        items, members = [], []
+        for vid, row in zip(ids, rows.to_dict('records')):
+            items.append((vid, 'add', {**row, 'id': vid}))
+            members += [(k, 'add', m) for k, m in _member_rows(vid, row['sv_members'], row['members']).items()]
+        write_queue.enqueue_many("stores", [(n, 'add', {"store_name": n, "notices": "", "memo": ""}) for n in prepared['stores']])
+        write_queue.enqueue_many("employees", [(n, 'add', {'name': n}) for n in prepared['employees']])
+        write_queue.enqueue_many("visit_members", members)
+        write_queue.enqueue_many("visits", items)
+    else:
+        key_col = WORKSHEET_KEYS[target][0]
+        write_queue.enqueue_many(target, [(row[key_col], 'add', row) for row in rows.to_dict('records')])
+    flush_writes()
+    return len(rows)
+
+def export_csv(target):
+    # バックアップ用 CSV を作る関数を返す (ボタンが押された時に別スレッドで実行される)。
+    # 記録はアーカイブも含め、年ごと・EXPORT_CHUNK_ROWS 行ごとに書き出して全体を一度に文字列化しない。
+    # 書き出した内容はデータのバージョンごとに1回だけ作り、変わっていなければ使い回す
+    columns = WORKSHEET_KEYS[target][1]
+    years = sorted(archived_years()) if target == "visits" else []
+    def build():
+        buf = io.BytesIO()
+        buf.write("\ufeff".encode("utf-8"))  # Excel で文字化けしないよう BOM 付き
+        header = True
+        for df in [visits_partition(y) for y in years] + [replicas[target].view(*write_queue.overlay(target))]:
+            for i in range(0, len(df), EXPORT_CHUNK_ROWS):
+                buf.write(_cell_frame(df.iloc[i:i + EXPORT_CHUNK_ROWS], columns).to_csv(index=False, header=header).encode("utf-8"))
+                header = False
+        if header: buf.write((",".join(columns) + "\n").encode("utf-8"))
+        return buf.getvalue()
+    def generate():
+        for y in years: visits_partition(y)  # バージョンを引く前に読み込んでおく
+        return io.BytesIO(get_index(f"export_{target}", tuple(_archive_sheet(y) for y in years) + (target,), build))
+    return generate
+
+# --- カレンダー表 (年ごとに1回だけ構築し、全セッションで共有) ---
+WEEKDAY_LABELS = ["日", "月", "火", "水", "木", "金", "土"]
+
+@st.cache_resource
+def year_calendar(year):
+    # {date: {'wk': 曜日 (0=日), 'label': 曜日名, 'holiday': 祝日名 or "", 'css': 表示クラス}}
+    holidays = dict(jpholiday.year_holidays(year))
+    table = {}
+    d = datetime.date(year, 1, 1)
+    while d.year == year:
+        wk = (d.weekday() + 1) % 7
+        holiday = holidays.get(d, "")
+        css = "day-sun" if wk == 0 else "day-sat" if wk == 6 else "day-hol" if holiday else "day-wkd"
+        table[d] = {'wk': wk, 'label': WEEKDAY_LABELS[wk], 'holiday': holiday, 'css': css}
+        d += datetime.timedelta(days=1)
+    return table
+
+def month_days(year, month):
+    # その月の (日, date, カレンダー情報) を順に返す
+    table = year_calendar(year)
+    num_days = calendar.monthrange(year, month)[1]
+    return [(day, date, table[date]) for day, date in ((d, datetime.date(year, month, d)) for d in range(1, num_days + 1))]
 
 # --- 4. セッション管理 ---
 if 'selected_store' not in st.session_state:
@@ -222,6 +1251,8 @@ if 'edit_record_id' not in st.session_state:
     st.session_state.edit_record_id = None
 if 'search_add_mode' not in st.session_state:
     st.session_state.search_add_mode = False
+if 'cal_grid_nonce' not in st.session_state:
+    st.session_state.cal_grid_nonce = 0
 
 def navigate_to(store_name=None):
     if store_name: st.session_state.selected_store = store_name
@@ -234,20 +1265,79 @@ def change_cal_month(amount):
     st.session_state.cal_month = m
     st.session_state.cal_year = y
 
+# ★ 画面の一部だけを再実行する (各タブ・月表示・記録一覧はそれぞれフラグメント)
+# key なし: 操作されたフラグメントだけ。key あり (ボタンの on_click から): 指定したフラグメントだけ。
+# フラグメントの外やアプリ全体の再実行中はアプリ全体を再実行する
+def rerun_section(key=None):
+    try:
+        st.rerun(key or "fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def open_cal_day(date):
+    st.session_state.cal_selected_date = date
+    st.session_state.cal_view_mode = 'day'
+    rerun_section("tab_cal")
+
 # --- 5. UIコンポーネント ---
+HISTORY_PAGE_SIZE = 20  # 店舗詳細の記録を一度に表示する件数
+
+# ★ 画面の操作はほとんどがタブ単位の再実行なので、状態表示は独立させて一定間隔で描き直す
+SYNC_STATUS_INTERVAL = 5  # 秒
+
+@st.fragment(run_every=SYNC_STATUS_INTERVAL, key="sync_status")
+def render_sync_status():
+    # ★ 読み込み・保存の失敗は隠さずに知らせる (表示は前回読めた内容のまま、保存は自動で再送される)
+    failed = [ws for ws, r in replicas.items() if r.error is not None]
+    if failed:
+        st.warning(f"最新のデータを読み込めませんでした ({', '.join(failed)})。前回読み込んだ内容を表示しています。\n\n{replicas[failed[0]].error}")
+    if write_queue.error is not None:
+        st.error(f"保存した変更 {write_queue.pending_count()}件をまだシートに書き込めていません。自動で再送します。\n\n{write_queue.error}")
+    if write_queue.journal_error is not None:
+        st.error(f"再起動前に保存した変更の一部を復元できませんでした。\n\n{write_queue.journal_error}")
+
 def member_selector(label, key_suffix, default_vals=None):
     st.markdown(f"<label style='font-size:14px; color:#bbb;'>{label}</label>", unsafe_allow_html=True)
     employees = get_employees_list()
     
-    def_selected = []
-    if default_vals:
-        def_selected = [n.strip() for n in default_vals.split(',') if n.strip() in employees]
+    known = set(employees)
+    def_selected = [n for n in (default_vals or []) if n in known]
 
     selected = st.multiselect("メンバーを選択", options=employees, default=def_selected, placeholder="名前を検索...", label_visibility="collapsed", key=f"ms_{key_suffix}")
     st.caption("リストにない人は↓に入力 (改行区切り)。保存時に自動追加されます。")
     new_members_text = st.text_area("新規追加", placeholder="例:\n佐藤\n高橋", label_visibility="collapsed", height=60, key=f"new_{key_suffix}")
     return selected, new_members_text
 
+@metrics.timer("screen", "calendar_compact")
+def render_month_compact(year, month, visits_map):
+    # ★ 軽量カレンダー: 1か月分を1つの表として送り、タップされた日付だけを受け取る
+    days = month_days(year, month)
+    num_days = len(days)
+    today = datetime.date.today()
+    day_colors = {"day-sun": "#ff6666", "day-sat": "#4da6ff", "day-hol": "#ff6666", "day-wkd": "#ddd"}
+
+    rows, styles = [], []
+    for day, curr_date, info in days:
+        stores = visits_map.get(day, [])
+        rows.append({"日付": f"{day} ({info['label']})", "記録": " / ".join(stores) if stores else "記録なし"})
+        bg = "background-color: rgba(77, 166, 255, 0.1);" if curr_date == today else ""
+        styles.append([f"color: {day_colors[info['css']]}; font-weight: bold; {bg}", f"color: {'#eee' if stores else '#aaa'}; {bg}"])
+
+    df = pd.DataFrame(rows)
+    styler = df.style.apply(lambda _: pd.DataFrame(styles, columns=df.columns), axis=None)
+    key = f"cal_grid_{year}_{month}_{st.session_state.cal_grid_nonce}"
+    def on_pick():
+        picked = st.session_state[key]['selection']['rows']
+        if picked:
+            # 戻ってきた時に選択が残らないようキーを変える
+            st.session_state.cal_grid_nonce += 1
+            open_cal_day(datetime.date(year, month, picked[0] + 1))
+    st.dataframe(
+        styler, hide_index=True, use_container_width=True, height=35 * (num_days + 1) + 3,
+        on_select=on_pick, selection_mode="single-row", key=key,
+    )
+
+@metrics.timer("screen", "add_visit")
 def render_add_visit_screen(store, back_callback, mode_prefix="default"):
     c1, c2 = st.columns([0.3, 0.7])
     if c1.button("◀ キャンセル", type="secondary", key=f"cncl_{mode_prefix}"):
@@ -290,12 +1380,11 @@ def render_add_visit_screen(store, back_callback, mode_prefix="default"):
             e_time_str = end_t.strftime("%H:%M") if end_t else ""
             
             sv_manual = [n.strip() for n in txt_sv.splitlines() if n.strip()]
-            final_sv = list(set(sel_sv + sv_manual))
-            check_and_add_employees(sv_manual)
+            final_sv = list(dict.fromkeys(sel_sv + sv_manual))
             
             mem_manual = [n.strip() for n in txt_mems.splitlines() if n.strip()]
-            final_mem = list(set(sel_mems + mem_manual))
-            check_and_add_employees(mem_manual)
+            final_mem = list(dict.fromkeys(sel_mems + mem_manual))
+            check_and_add_employees(sv_manual + mem_manual)
             
             new_data = {
                 "store_name": store, "visit_date": d_str, "visit_time": "", # visit_timeは互換用
@@ -310,11 +1399,21 @@ def render_add_visit_screen(store, back_callback, mode_prefix="default"):
             add_visit_data(new_data)
             st.success("追加しました")
             back_callback()
-            st.rerun()
 
+@metrics.timer("screen", "edit_visit")
 def render_edit_visit_screen(record_id, store, back_callback, mode_prefix="edit"):
-    df = get_visits_data()
-    record = df[df['id'] == record_id].iloc[0]
+    record = get_visit_repo().row(record_id)
+    if record is None:
+        # 他の端末で削除された・アーカイブに移された記録
+        st.session_state.edit_record_id = None
+        st.warning("この記録は見つかりませんでした。削除されたか、アーカイブに移された可能性があります。")
+        if st.button("◀ 戻る", type="secondary", key=f"back_missing_{mode_prefix}"):
+            back_callback()
+        return
+    # 開いた時点の内容を覚えておき、保存時は変えた項目だけを送る
+    base_key = f"edit_base_{mode_prefix}_{record_id}"
+    if base_key not in st.session_state:
+        st.session_state[base_key] = {k: to_cell(v) for k, v in record.items()}
     
     c1, c2 = st.columns([0.3, 0.7])
     if c1.button("◀ キャンセル", type="secondary", key=f"cncl_edit_{mode_prefix}"):
@@ -323,23 +1422,15 @@ def render_edit_visit_screen(record_id, store, back_callback, mode_prefix="edit"
     st.markdown(f'<div class="store-header">記録の編集</div>', unsafe_allow_html=True)
     st.caption(f"店舗: {store}")
 
-    init_date = None
-    if record['visit_date']:
-        try: init_date = datetime.datetime.strptime(record['visit_date'], "%Y-%m-%d").date()
-        except: pass
+    # 読み込み時に型変換済み (日付は Timestamp、時間は Timedelta、空欄は NaT)
+    init_date = record['visit_date'].date() if pd.notna(record['visit_date']) else None
     
     # 時間の初期値
-    init_s_time = None
-    init_e_time = None
-    if 'start_time' in record and record['start_time']:
-        try: init_s_time = datetime.datetime.strptime(record['start_time'], "%H:%M").time()
-        except: pass
-    if 'end_time' in record and record['end_time']:
-        try: init_e_time = datetime.datetime.strptime(record['end_time'], "%H:%M").time()
-        except: pass
+    init_s_time = (datetime.datetime.min + record['start_time']).time() if pd.notna(record['start_time']) else None
+    init_e_time = (datetime.datetime.min + record['end_time']).time() if pd.notna(record['end_time']) else None
         
     # 評価の初期値
-    init_rating = int(record.get('rating', 3))
+    init_rating = int(record['rating'])
     if init_rating < 1: init_rating = 1
     if init_rating > 5: init_rating = 5
 
@@ -354,8 +1445,9 @@ def render_edit_visit_screen(record_id, store, back_callback, mode_prefix="edit"
     st.markdown("<label style='font-size:14px; color:#bbb;'>評価 (1-5)</label>", unsafe_allow_html=True)
     rating_val = st.slider("評価", 1, 5, init_rating, key=f"rate_edit_{mode_prefix}_{record_id}", label_visibility="collapsed")
 
-    init_sv = record.get('sv_members', '')
-    init_mem = record.get('members', '')
+    member_index = get_member_index()
+    init_sv = member_index.members_of(record_id, 'sv')
+    init_mem = member_index.members_of(record_id, 'member')
     
     sel_sv, txt_sv = member_selector("SV", f"sv_edit_{mode_prefix}_{record_id}", default_vals=init_sv)
     st.write("")
@@ -376,12 +1468,11 @@ def render_edit_visit_screen(record_id, store, back_callback, mode_prefix="edit"
             e_time_str = end_t.strftime("%H:%M") if end_t else ""
             
             sv_manual = [n.strip() for n in txt_sv.splitlines() if n.strip()]
-            final_sv = list(set(sel_sv + sv_manual))
-            check_and_add_employees(sv_manual)
+            final_sv = list(dict.fromkeys(sel_sv + sv_manual))
             
             mem_manual = [n.strip() for n in txt_mems.splitlines() if n.strip()]
-            final_mem = list(set(sel_mems + mem_manual))
-            check_and_add_employees(mem_manual)
+            final_mem = list(dict.fromkeys(sel_mems + mem_manual))
+            check_and_add_employees(sv_manual + mem_manual)
             
             updated_data = {
                 "visit_date": d_str,
@@ -393,56 +1484,54 @@ def render_edit_visit_screen(record_id, store, back_callback, mode_prefix="edit"
                 "count_area": new_area,
                 "record_memo": new_rec_memo
             }
-            update_visit_data(record_id, updated_data)
+            update_visit_data(record_id, updated_data, base=st.session_state.pop(base_key, None))
             st.success("更新しました")
             back_callback()
-            st.rerun()
 
-def render_store_detail_content(store, back_callback, add_callback, mode_prefix="default"):
-    if st.session_state.edit_record_id:
-        def close_edit():
-            st.session_state.edit_record_id = None
-            st.rerun()
-        render_edit_visit_screen(st.session_state.edit_record_id, store, close_edit, mode_prefix)
-        return
+def open_edit(record_id, mode_prefix):
+    st.session_state.edit_record_id = record_id
+    st.session_state.pop(f"edit_base_{mode_prefix}_{record_id}", None)
+    rerun_section(f"tab_{mode_prefix}")
 
-    c_back, _ = st.columns([0.25, 0.75])
-    if c_back.button("◀ 戻る", type="secondary", key=f"back_{mode_prefix}"):
-        back_callback()
-    
-    # ★ 店舗ヘッダーと平均評価
-    visits_df = get_visits_data()
-    stores_df = get_stores_data()
-    store_visits = visits_df[visits_df['store_name'] == store].sort_values(by='visit_date', ascending=False)
-    
-    # 平均評価の計算
-    avg_rating = 0.0
-    valid_ratings = store_visits[store_visits['rating'] > 0]['rating']
-    if not valid_ratings.empty:
-        avg_rating = valid_ratings.mean()
-    
-    st.markdown(f'<div class="store-header">{store}</div>', unsafe_allow_html=True)
-    
-    # 評価表示
-    star_str = "★" * int(round(avg_rating)) + "☆" * (5 - int(round(avg_rating)))
-    st.markdown(f"""
-    <div class="store-sub-header">
-        <span>平均評価: <span class="rating-star">{avg_rating:.1f}</span></span>
-        <span style="color:#888;">{star_str}</span>
-        <span style="color:#666; font-size:12px;">({len(store_visits)}件の記録)</span>
-    </div>
-    """, unsafe_allow_html=True)
-    
+def delete_and_refresh(record_id, mode_prefix):
+    delete_visit_data(record_id)
+    rerun_section(f"tab_{mode_prefix}")
+
+# ★ 店舗の記録一覧 (期間・過去の記録・さらに表示の操作ではこの一覧だけを再実行する)
+@st.fragment(key="store_history")
+def render_store_history(store, mode_prefix):
     st.markdown('<div class="section-title">記録</div>', unsafe_allow_html=True)
-    if store_visits.empty:
+    # ★ 期間で絞り込み、新しい順に HISTORY_PAGE_SIZE 件ずつ表示 (店舗・日付の索引から切り出す)
+    c_from, c_to = st.columns(2)
+    d_from = c_from.date_input("開始日", value=None, key=f"hist_from_{mode_prefix}")
+    d_to = c_to.date_input("終了日", value=None, key=f"hist_to_{mode_prefix}")
+    hist = get_visit_repo().store_visits(store, d_from, d_to)
+    # アーカイブ済みの年は、期間指定がその年にかかる時か「過去の記録」を押した時だけ読む
+    archive_key = f"hist_archive_{mode_prefix}_{store}"
+    arch_years = sorted(y for y, stores in get_archive_index()[0].items() if store in stores)
+    in_range = [y for y in arch_years if (not d_from or d_from.year <= y) and (not d_to or y <= d_to.year)]
+    archive_ids = set()
+    if in_range and (st.session_state.get(archive_key) or d_from or d_to):
+        archived = archived_store_visits(store, in_range, d_from, d_to)
+        if archived is not None:
+            archive_ids = set(archived['id'])
+            hist = pd.concat([hist, archived], ignore_index=True).sort_values(by='visit_date', ascending=False)
+    elif in_range:
+        if st.button(f"過去の記録も表示 ({in_range[0]}〜{in_range[-1]}年)", key=f"arch_{mode_prefix}", type="secondary", use_container_width=True):
+            st.session_state[archive_key] = True
+            rerun_section()
+    limit_key = f"hist_limit_{mode_prefix}_{store}"
+    limit = st.session_state.get(limit_key, HISTORY_PAGE_SIZE)
+
+    if hist.empty:
         st.caption("記録なし")
     else:
-        for _, row in store_visits.iterrows():
-            date_disp = row['visit_date'] if row['visit_date'] else "日付なし"
+        for _, row in hist.head(limit).iterrows():
+            date_disp = to_cell(row['visit_date']) or "日付なし"
             
             # 時間表示
-            t_s = row.get('start_time', '')
-            t_e = row.get('end_time', '')
+            t_s = to_cell(row['start_time'])
+            t_e = to_cell(row['end_time'])
             time_disp = f"{t_s} ~ {t_e}" if (t_s or t_e) else ""
             
             mem_disp = row['members'] if row['members'] else "-"
@@ -452,7 +1541,7 @@ def render_store_detail_content(store, back_callback, add_callback, mode_prefix=
             rec_memo = row.get('record_memo', '')
             
             # 評価 (リスト内表示)
-            r_val = int(row.get('rating', 0))
+            r_val = int(row['rating'])
             r_star = "★" * r_val if r_val > 0 else "-"
             
             st.markdown('<div class="visit-row-container">', unsafe_allow_html=True)
@@ -476,149 +1565,126 @@ def render_store_detail_content(store, back_callback, add_callback, mode_prefix=
             
             with c_act:
                 st.markdown('<div style="height: 0px;"></div>', unsafe_allow_html=True)
-                if st.button("詳細", key=f"edit_{mode_prefix}_{row['id']}", type="secondary"):
-                    st.session_state.edit_record_id = row['id']
-                    st.rerun()
-                if st.button("削除", key=f"del_{mode_prefix}_{row['id']}", type="secondary"):
-                    delete_visit_data(row['id'])
-                    st.rerun()
+                if row['id'] in archive_ids:
+                    st.caption("アーカイブ")  # 閲覧のみ
+                else:
+                    # 編集画面への切り替えと削除は店舗詳細 (タブ) ごと再実行する (平均評価・件数も変わるため)
+                    st.button("詳細", key=f"edit_{mode_prefix}_{row['id']}", type="secondary", on_click=open_edit, args=(row['id'], mode_prefix))
+                    st.button("削除", key=f"del_{mode_prefix}_{row['id']}", type="secondary", on_click=delete_and_refresh, args=(row['id'], mode_prefix))
             
             st.markdown('</div>', unsafe_allow_html=True)
 
+        if len(hist) > limit:
+            st.caption(f"{len(hist)}件中 {limit}件を表示")
+            if st.button("さらに表示", key=f"more_{mode_prefix}", type="secondary", use_container_width=True):
+                st.session_state[limit_key] = limit + HISTORY_PAGE_SIZE
+                rerun_section()
+
+@metrics.timer("screen", "store_detail")
+def render_store_detail_content(store, back_callback, add_callback, mode_prefix="default"):
+    if st.session_state.edit_record_id:
+        def close_edit():
+            st.session_state.edit_record_id = None
+            rerun_section()
+        render_edit_visit_screen(st.session_state.edit_record_id, store, close_edit, mode_prefix)
+        return
+
+    c_back, _ = st.columns([0.25, 0.75])
+    if c_back.button("◀ 戻る", type="secondary", key=f"back_{mode_prefix}"):
+        back_callback()
+    
+    # ★ 店舗ヘッダーと平均評価 (店舗ごとの集計から引く)
+    summary = get_store_summary()
+    avg_rating = summary.avg_rating(store)
+    
+    st.markdown(f'<div class="store-header">{store}</div>', unsafe_allow_html=True)
+    
+    # 評価表示
+    star_str = "★" * int(round(avg_rating)) + "☆" * (5 - int(round(avg_rating)))
+    st.markdown(f"""
+    <div class="store-sub-header">
+        <span>平均評価: <span class="rating-star">{avg_rating:.1f}</span></span>
+        <span style="color:#888;">{star_str}</span>
+        <span style="color:#666; font-size:12px;">({summary.get(store)['count']}件の記録)</span>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    render_store_history(store, mode_prefix)
+
     st.write("")
     if st.button("新しい記録を追加", key=f"add_btn_{mode_prefix}", type="primary", use_container_width=True):
         add_callback()
 
     st.markdown('<div class="section-title">店舗情報 (編集可)</div>', unsafe_allow_html=True)
-    this_store = stores_df[stores_df['store_name'] == store]
-    init_notices = this_store.iloc[0]['notices'] if not this_store.empty else ""
-    init_memo = this_store.iloc[0]['memo'] if not this_store.empty else ""
+    this_store = get_store_repo().row(store)
+    init_notices = this_store['notices'] if this_store is not None else ""
+    init_memo = this_store['memo'] if this_store is not None else ""
+    base_key = f"store_base_{mode_prefix}_{store}"
+    if base_key not in st.session_state:
+        st.session_state[base_key] = {"notices": init_notices, "memo": init_memo, UPDATED_AT: this_store.get(UPDATED_AT, "") if this_store is not None else None}
 
     with st.form(f"update_info_{mode_prefix}"):
         new_notices = st.text_area("注意事項", value=init_notices, height=100)
         new_memo = st.text_area("メモ", value=init_memo, height=100)
         if st.form_submit_button("保存", type="primary"):
-            update_store_info(store, new_notices, new_memo)
+            update_store_info(store, new_notices, new_memo, base=st.session_state.pop(base_key, None))
             st.success("更新しました")
-            st.rerun()
+            rerun_section()
+
+@st.fragment(key="tab_perf")
+def render_perf_panel():
+    # ★ 計測結果 (URL に ?admin=1 を付けた時だけ表示)
+    st.caption("この端末のプロセスで計測した直近の結果です (全セッション合算)")
+    summary = metrics.summary()
+    st.markdown('<div class="section-title">所要時間 (ms)</div>', unsafe_allow_html=True)
+    if summary.empty: st.caption("まだ計測データがありません")
+    else: st.dataframe(summary, hide_index=True, use_container_width=True)
+    st.markdown('<div class="section-title">キャッシュのヒット率</div>', unsafe_allow_html=True)
+    st.dataframe(metrics.hit_rates(), hide_index=True, use_container_width=True)
+    st.markdown('<div class="section-title">遅かった処理</div>', unsafe_allow_html=True)
+    st.dataframe(pd.DataFrame(metrics.slowest()), hide_index=True, use_container_width=True)
+    c1, c2 = st.columns(2)
+    c1.download_button("ログを書き出し (JSON Lines)", data=metrics.to_jsonl, file_name=f"perf_{datetime.datetime.now():%Y%m%d_%H%M}.jsonl",
+                       mime="application/x-ndjson", on_click="ignore", use_container_width=True)
+    if c2.button("リセット", key="perf_reset", type="secondary", use_container_width=True):
+        metrics.reset()
+        rerun_section()
 
 # --- 6. メインUI ---
 st.title("店舗記録ログ")
-
-tab_calendar, tab_search, tab_register = st.tabs(["カレンダー", "店舗一覧・検索", "新規登録"])
+render_sync_status()
 
 # ==========================================
 # TAB 1: カレンダー
 # ==========================================
-with tab_calendar:
+# ★ 月表示 (月の切り替え・軽量表示の切り替えではこの部分だけを再実行する)
+@st.fragment(key="cal_month")
+def render_month_view():
     year = st.session_state.cal_year
     month = st.session_state.cal_month
+    st.write("")
+    c1, c2, c3 = st.columns([1, 3, 1])
     
-    # --- 画面F: 日次詳細画面 ---
-    if st.session_state.cal_view_mode == 'day':
-        target_date = st.session_state.cal_selected_date
-        d_str = target_date.strftime("%Y-%m-%d")
+    c1.button("◀", key="cal_prev", on_click=change_cal_month, args=(-1,), use_container_width=True)
+    c2.markdown(f"<div style='text-align:center; font-weight:bold; padding-top:5px;'>{year}年 {month}月</div>", unsafe_allow_html=True)
+    c3.button("▶", key="cal_next", on_click=change_cal_month, args=(1,), use_container_width=True)
         
-        if st.button("◀ カレンダー戻る", type="secondary", use_container_width=True):
-            st.session_state.cal_view_mode = 'month'
-            st.rerun()
-            
-        st.markdown(f"###  {d_str} の記録")
-        
-        visits_df = get_visits_data()
-        day_visits = visits_df[visits_df['visit_date'] == d_str]
-        
-        if day_visits.empty:
-            st.info("この日の記録はありません")
-        else:
-            for _, row in day_visits.iterrows():
-                s_name = row['store_name']
-                mem = row['members']
-                area = row['count_area']
-                # 評価と時間
-                r_val = int(row.get('rating', 0))
-                r_star = "★" * r_val if r_val > 0 else "-"
-                t_s = row.get('start_time', '')
-                t_e = row.get('end_time', '')
-                time_lbl = f"{t_s}~{t_e}" if (t_s or t_e) else ""
-                
-                with st.container():
-                    st.markdown(f"""
-                    <div class="day-card">
-                        <div class="day-card-store">{s_name} <span style="font-size:12px; color:#ffd700;">{r_star}</span></div>
-                        <div class="day-card-info">{time_lbl}</div>
-                        <div class="day-card-info">メンバー: {mem}</div>
-                        <div class="day-card-info">アサイン: {area}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    if st.button(f"詳細へ", key=f"cal_day_btn_{row['id']}", type="secondary", use_container_width=True):
-                        st.session_state.cal_view_mode = 'store'
-                        st.session_state.selected_store = s_name
-                        st.rerun()
+    compact = st.toggle("軽量表示 (電波が弱い時に)", key="cal_compact")
+    
+    visits_map = month_visits_map(year, month)
 
-    # --- 画面G: カレンダー内店舗詳細 ---
-    elif st.session_state.cal_view_mode == 'store' and st.session_state.selected_store:
-        def back_to_day():
-            st.session_state.cal_view_mode = 'day'
-            st.session_state.edit_record_id = None
-            st.rerun()
-        def go_to_add():
-            st.session_state.cal_view_mode = 'add'
-            st.rerun()
-        render_store_detail_content(st.session_state.selected_store, back_to_day, go_to_add, mode_prefix="cal")
-
-    # --- 画面H: カレンダー内追加 ---
-    elif st.session_state.cal_view_mode == 'add' and st.session_state.selected_store:
-        def back_to_store():
-            st.session_state.cal_view_mode = 'store'
-            st.rerun()
-        render_add_visit_screen(st.session_state.selected_store, back_to_store, mode_prefix="cal")
-
-    # --- 画面E: 月表示カレンダー (縦リスト) ---
+    if compact:
+        render_month_compact(year, month, visits_map)
     else:
-        st.write("")
-        c1, c2, c3 = st.columns([1, 3, 1])
-        
-        if c1.button("◀", key="cal_prev", use_container_width=True):
-            change_cal_month(-1)
-            st.rerun()
-        c2.markdown(f"<div style='text-align:center; font-weight:bold; padding-top:5px;'>{year}年 {month}月</div>", unsafe_allow_html=True)
-        if c3.button("▶", key="cal_next", use_container_width=True):
-            change_cal_month(1)
-            st.rerun()
-            
-        st.write("")
-        
-        df = get_visits_data()
-        visits_map = {}
-        if not df.empty:
-            for _, row in df.iterrows():
-                try:
-                    d_obj = datetime.datetime.strptime(row['visit_date'], "%Y-%m-%d").date()
-                    if d_obj.year == year and d_obj.month == month:
-                        day = d_obj.day
-                        if day not in visits_map: visits_map[day] = []
-                        visits_map[day].append(row['store_name'])
-                except: continue
-
         with st.container(height=600, border=False):
-            num_days = calendar.monthrange(year, month)[1]
             today = datetime.date.today()
-            weekday_map = ["日", "月", "火", "水", "木", "金", "土"]
+        
+            for day, curr_date, info in month_days(year, month):
+                day_class = info['css']
             
-            for day in range(1, num_days + 1):
-                curr_date = datetime.date(year, month, day)
-                wk_idx = int(curr_date.strftime('%w'))
-                
-                day_class = "day-wkd"
-                if wk_idx == 0: day_class = "day-sun"
-                elif wk_idx == 6: day_class = "day-sat"
-                elif jpholiday.is_holiday(curr_date): day_class = "day-hol"
-                
                 has_visit = day in visits_map
                 stores = visits_map[day] if has_visit else []
-                
+            
                 stores_html = ""
                 if stores:
                     for s in stores:
@@ -627,96 +1693,172 @@ with tab_calendar:
                     stores_html = '<div class="cal-store-sub">記録なし</div>'
 
                 row_class = "row-today" if curr_date == today else ""
-                
+            
                 c_row = st.columns([0.85, 0.15])
                 with c_row[0]:
                     st.markdown(f"""
                     <div class="cal-list-row {row_class}">
                         <div class="cal-date-box">
                             <div class="date-num {day_class}">{day}</div>
-                            <div class="date-week {day_class}">{weekday_map[wk_idx]}</div>
+                            <div class="date-week {day_class}">{info['label']}</div>
                         </div>
                         <div class="cal-info-box">{stores_html}</div>
                     </div>
                     """, unsafe_allow_html=True)
-                
+            
                 with c_row[1]:
                     st.markdown('<div style="height: 15px;"></div>', unsafe_allow_html=True)
                     btn_type = "primary" if has_visit else "secondary"
-                    if st.button("詳細", key=f"cal_list_btn_{day}", type=btn_type):
-                        st.session_state.cal_selected_date = curr_date
-                        st.session_state.cal_view_mode = 'day'
-                        st.rerun()
+                    st.button("詳細", key=f"cal_list_btn_{day}", type=btn_type, on_click=open_cal_day, args=(curr_date,))
+
+    with st.expander(f"{month}月のメンバー別件数"):
+        # 集計は開いて押した時だけ (月表示のたびに人ごとのインデックスを作らない)
+        if st.toggle("件数を集計する", key="cal_member_counts"):
+            counts = month_member_counts(year, month)
+            if counts.empty: st.caption("記録なし")
+            else: st.dataframe(counts.rename("件数"), use_container_width=True)
+
+@st.fragment(key="tab_cal")
+def render_calendar_tab():
+    with metrics.timer("screen", f"calendar_{st.session_state.cal_view_mode}"):
+        # --- 画面F: 日次詳細画面 ---
+        if st.session_state.cal_view_mode == 'day':
+            target_date = st.session_state.cal_selected_date
+            d_str = target_date.strftime("%Y-%m-%d")
+        
+            if st.button("◀ カレンダー戻る", type="secondary", use_container_width=True):
+                st.session_state.cal_view_mode = 'month'
+                rerun_section()
+            
+            st.markdown(f"###  {d_str} の記録")
+        
+            day_visits = visits_on_date(target_date)
+        
+            if day_visits.empty:
+                st.info("この日の記録はありません")
+            else:
+                for _, row in day_visits.iterrows():
+                    s_name = row['store_name']
+                    mem = row['members']
+                    area = row['count_area']
+                    # 評価と時間
+                    r_val = int(row['rating'])
+                    r_star = "★" * r_val if r_val > 0 else "-"
+                    t_s = to_cell(row['start_time'])
+                    t_e = to_cell(row['end_time'])
+                    time_lbl = f"{t_s}~{t_e}" if (t_s or t_e) else ""
+                
+                    with st.container():
+                        st.markdown(f"""
+                        <div class="day-card">
+                            <div class="day-card-store">{s_name} <span style="font-size:12px; color:#ffd700;">{r_star}</span></div>
+                            <div class="day-card-info">{time_lbl}</div>
+                            <div class="day-card-info">メンバー: {mem}</div>
+                            <div class="day-card-info">アサイン: {area}</div>
+                        </div>
+                        """, unsafe_allow_html=True)
+                    
+                        if st.button(f"詳細へ", key=f"cal_day_btn_{row['id']}", type="secondary", use_container_width=True):
+                            st.session_state.cal_view_mode = 'store'
+                            st.session_state.selected_store = s_name
+                            rerun_section()
+
+        # --- 画面G: カレンダー内店舗詳細 ---
+        elif st.session_state.cal_view_mode == 'store' and st.session_state.selected_store:
+            def back_to_day():
+                st.session_state.cal_view_mode = 'day'
+                st.session_state.edit_record_id = None
+                rerun_section()
+            def go_to_add():
+                st.session_state.cal_view_mode = 'add'
+                rerun_section()
+            render_store_detail_content(st.session_state.selected_store, back_to_day, go_to_add, mode_prefix="cal")
+
+        # --- 画面H: カレンダー内追加 ---
+        elif st.session_state.cal_view_mode == 'add' and st.session_state.selected_store:
+            def back_to_store():
+                st.session_state.cal_view_mode = 'store'
+                rerun_section()
+            render_add_visit_screen(st.session_state.selected_store, back_to_store, mode_prefix="cal")
+
+        # --- 画面E: 月表示カレンダー (縦リスト) ---
+        else:
+            render_month_view()
 
 # ==========================================
 # TAB 2: 検索・詳細
 # ==========================================
-with tab_search:
-    
-    # --- 画面C: 訪問追加画面 ---
-    if st.session_state.search_add_mode and st.session_state.selected_store:
-        def back_from_add():
-            st.session_state.search_add_mode = False
-            st.rerun()
-        render_add_visit_screen(st.session_state.selected_store, back_from_add, mode_prefix="search")
-
-    # --- 画面B: 店舗詳細画面 ---
-    elif st.session_state.selected_store:
-        def back_to_list():
-            st.session_state.selected_store = None
-            st.session_state.edit_record_id = None
-            st.rerun()
-        def to_add():
-            st.session_state.search_add_mode = True
-            st.rerun()
-        render_store_detail_content(st.session_state.selected_store, back_to_list, to_add, mode_prefix="search")
+@st.fragment(key="tab_search")
+def render_search_tab():
+    with metrics.timer("screen", "search"):
     
-    # --- 画面A: 店舗一覧画面 ---
-    else:
-        st.write("")
-        search_query = st.text_input("キーワード検索", placeholder="店舗名 / メンバー名 / 注意事項など")
-        stores_df = get_stores_data()
-        visits_df = get_visits_data()
-        
-        if stores_df.empty:
-            st.info("データがありません")
+        # --- 画面C: 訪問追加画面 ---
+        if st.session_state.search_add_mode and st.session_state.selected_store:
+            def back_from_add():
+                st.session_state.search_add_mode = False
+                rerun_section()
+            render_add_visit_screen(st.session_state.selected_store, back_from_add, mode_prefix="search")
+
+        # --- 画面B: 店舗詳細画面 ---
+        elif st.session_state.selected_store:
+            def back_to_list():
+                st.session_state.selected_store = None
+                st.session_state.edit_record_id = None
+                rerun_section()
+            def to_add():
+                st.session_state.search_add_mode = True
+                rerun_section()
+            render_store_detail_content(st.session_state.selected_store, back_to_list, to_add, mode_prefix="search")
+    
+        # --- 画面A: 店舗一覧画面 ---
         else:
-            all_names = stores_df['store_name'].unique()
-            matched = set()
-            
-            c_opt1, c_opt2, c_opt3 = st.columns(3)
-            use_store = c_opt1.checkbox("店舗名", True)
-            use_member = c_opt2.checkbox("メンバー")
-            use_memo = c_opt3.checkbox("注意事項・メモ")
-
-            if search_query:
-                q = search_query.strip()
-                if use_store:
-                    hits = stores_df[stores_df['store_name'].astype(str).str.contains(q, case=False, na=False)]
-                    matched.update(hits['store_name'].tolist())
-                if use_memo:
-                    hits = stores_df[stores_df['notices'].astype(str).str.contains(q, case=False, na=False) | stores_df['memo'].astype(str).str.contains(q, case=False, na=False)]
-                    matched.update(hits['store_name'].tolist())
-                if use_member and not visits_df.empty:
-                    hits = visits_df[visits_df['members'].astype(str).str.contains(q, case=False, na=False)]
-                    matched.update(hits['store_name'].unique().tolist())
-                filtered = sorted(list(matched))
+            st.write("")
+            search_query = st.text_input("キーワード検索", placeholder="店舗名 / メンバー名 / 注意事項など (スペース区切りで絞り込み)")
+            stores_df = get_stores_data()
+        
+            if stores_df.empty:
+                st.info("データがありません")
             else:
-                filtered = sorted(all_names)
+                all_names = stores_df['store_name'].unique()
             
-            st.markdown(f"<div style='margin-bottom:10px; color:#888; font-size:12px;'>全 {len(filtered)} 店舗</div>", unsafe_allow_html=True)
+                c_opt1, c_opt2, c_opt3 = st.columns(3)
+                use_store = c_opt1.checkbox("店舗名", True)
+                use_member = c_opt2.checkbox("メンバー")
+                use_memo = c_opt3.checkbox("注意事項・メモ")
+
+                summary = get_store_summary()
+                if search_query.strip():
+                    groups = [g for g, use in (("store", use_store), ("member", use_member), ("memo", use_memo)) if use]
+                    filtered = get_search_index().search(search_query, groups)
+                    sort_mode = "店舗名"
+                else:
+                    # ★ 並び順は店舗ごとの集計だけで決める (記録は走査しない)
+                    sort_mode = st.radio("並び順", ["店舗名", "最終訪問", "平均評価"], horizontal=True, key="store_sort")
+                    filtered = sorted(all_names)
+                    if sort_mode == "最終訪問":
+                        filtered.sort(key=lambda n: summary.get(n)['last_date'], reverse=True)
+                    elif sort_mode == "平均評価":
+                        filtered.sort(key=summary.avg_rating, reverse=True)
             
-            st.markdown('<div class="list-btn-box">', unsafe_allow_html=True)
-            for s_name in filtered:
-                if st.button(f"{s_name}", key=f"btn_search_{s_name}", type="secondary", use_container_width=True):
-                    st.session_state.selected_store = s_name
-                    st.rerun()
-            st.markdown('</div>', unsafe_allow_html=True)
+                st.markdown(f"<div style='margin-bottom:10px; color:#888; font-size:12px;'>全 {len(filtered)} 店舗</div>", unsafe_allow_html=True)
+            
+                st.markdown('<div class="list-btn-box">', unsafe_allow_html=True)
+                for s_name in filtered:
+                    label = s_name
+                    if sort_mode == "最終訪問":
+                        label = f"{s_name}　({summary.get(s_name)['last_date'] or '記録なし'})"
+                    elif sort_mode == "平均評価":
+                        label = f"{s_name}　(★{summary.avg_rating(s_name):.1f})"
+                    if st.button(label, key=f"btn_search_{s_name}", type="secondary", use_container_width=True):
+                        st.session_state.selected_store = s_name
+                        rerun_section()
+                st.markdown('</div>', unsafe_allow_html=True)
 
 # ==========================================
 # TAB 3: 新規登録
 # ==========================================
-with tab_register:
+@st.fragment(key="tab_register")
+def render_register_tab():
     st.write("")
     
     with st.form("new_store_form", clear_on_submit=True):
@@ -732,16 +1874,64 @@ with tab_register:
             if not store_name_in:
                 st.error("店舗名を入力してください")
             else:
-                current_stores = get_stores_data()
-                if not current_stores.empty and store_name_in in current_stores['store_name'].values:
+                if store_name_in in get_store_repo():
                     st.warning("その店舗は既に存在します")
                     if st.button("詳細へ移動", type="secondary"):
                         st.session_state.selected_store = store_name_in
-                        st.rerun()
+                        rerun_section()
                 else:
                     with st.spinner("登録処理中..."):
                         register_new_store(store_name_in, notices_in, memo_in)
                         st.success(f"登録しました: {store_name_in}")
                         st.session_state.selected_store = store_name_in
 
-                        st.rerun()
+                        rerun_section()
+
+    # ★ 古い年の記録を年ごとのシートへ移す (visits シートを小さく保つ)
+    with st.expander("記録のアーカイブ"):
+        keep_from = datetime.date.today().year - ARCHIVE_KEEP_YEARS + 1
+        n_old = get_date_index().count_before(keep_from)
+        st.caption(f"{keep_from}年より前の記録を年ごとのシートへ移します。移した記録は閲覧のみになります。")
+        if st.button(f"{n_old}件をアーカイブ", key="archive_btn", type="secondary", disabled=n_old == 0, use_container_width=True):
+            with st.spinner("アーカイブ中..."):
+                moved = archive_old_visits(keep_from)
+            st.success(f"{moved}件をアーカイブしました")
+
+    # ★ CSV / Excel からの一括取り込みとバックアップ用の書き出し
+    with st.expander("一括取り込み・書き出し"):
+        target = st.selectbox("対象", list(IMPORT_TARGETS), format_func=IMPORT_TARGETS.get, key="import_target")
+        st.caption("列名はシートと同じ (記録: " + ", ".join(c for c in VISIT_COLUMNS if c != 'id') + ")。日付は 2024-01-31 / 2024/1/31、時間は 9:00 形式。")
+        upload = st.file_uploader("CSV / Excel", type=["csv", "xlsx"], key=f"import_file_{target}")
+        if upload is not None:
+            try:
+                prepared = prepare_import(target, read_upload(upload))
+            except ImportError:
+                st.error("Excel の読み込みには openpyxl が必要です (CSV なら不要)")
+                prepared = None
+            if prepared is not None:
+                st.write(f"取り込み {len(prepared['rows'])}件 / 重複でスキップ {prepared['skipped']}件 / エラー {len(prepared['errors'])}件")
+                if prepared['stores']: st.caption("新しく登録する店舗: " + ", ".join(prepared['stores']))
+                if prepared['employees']: st.caption("新しく登録する従業員: " + ", ".join(prepared['employees']))
+                if not prepared['errors'].empty:
+                    st.dataframe(prepared['errors'], hide_index=True, use_container_width=True)
+                if st.button("取り込む", key="import_btn", type="primary", disabled=prepared['rows'].empty, use_container_width=True):
+                    with st.spinner("取り込み中..."):
+                        n = commit_import(target, prepared)
+                    st.success(f"{n}件を取り込みました")
+
+        st.markdown("---")
+        today_str = datetime.date.today().strftime("%Y%m%d")
+        for ws, label in IMPORT_TARGETS.items():
+            st.download_button(f"{label}を書き出し (CSV)", data=export_csv(ws), file_name=f"{ws}_{today_str}.csv", mime="text/csv",
+                               key=f"export_{ws}", on_click="ignore", use_container_width=True)
+
+# ==========================================
+# タブ: 開いているタブだけを実行する (タブを切り替えた時だけアプリ全体を再実行)
+# ==========================================
+show_admin = st.query_params.get("admin") == "1"
+tab_pages = [("カレンダー", render_calendar_tab), ("店舗一覧・検索", render_search_tab), ("新規登録", render_register_tab)]
+if show_admin: tab_pages.append(("パフォーマンス", render_perf_panel))
+tabs = st.tabs([label for label, _ in tab_pages], key="main_tab", on_change="rerun")
+for tab, (_, render) in zip(tabs, tab_pages):
+    if tab.open:
+        with tab: render()
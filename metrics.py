@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import ContextDecorator
+
+import pandas as pd
+
+# --- 計測 (所要時間・キャッシュのヒット率) ---
+# ストレージ呼び出し・読み込み・インデックス構築・画面描画の時間を記録する。
+# 直近 maxlen 件だけをメモリに残し、log_path があれば JSON Lines で追記する。
+
+class Metrics:
+    def __init__(self, maxlen=5000, log_path=None):
+        self.events = deque(maxlen=maxlen)
+        self.hits = defaultdict(lambda: [0, 0])  # 名前 -> [ヒット, ミス]
+        self.log_path = log_path
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, seconds, ok=True, **detail):
+        event = {'ts': round(time.time(), 3), 'kind': kind, 'name': name, 'ms': round(seconds * 1000, 2), 'ok': ok, **detail}
+        with self.lock:
+            self.events.append(event)
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def hit(self, name, hit):
+        with self.lock:
+            self.hits[name][0 if hit else 1] += 1
+
+    def timer(self, kind, name, **detail):
+        # with 文でもデコレーターでも使える
+        return _Timer(self, kind, name, detail)
+
+    def summary(self):
+        # 種類・名前ごとの件数と所要時間 (ms)
+        with self.lock:
+            df = pd.DataFrame(list(self.events))
+        if df.empty: return df
+        g = df.groupby(['kind', 'name'])['ms']
+        out = pd.DataFrame({
+            '件数': g.size(), '平均': g.mean(), 'p50': g.median(), 'p95': g.quantile(0.95), '最大': g.max(),
+            '失敗': df.assign(ng=~df['ok']).groupby(['kind', 'name'])['ng'].sum(),
+        }).round(1)
+        return out.sort_values('p95', ascending=False).reset_index()
+
+    def hit_rates(self):
+        with self.lock:
+            rows = [(name, h, m) for name, (h, m) in self.hits.items()]
+        df = pd.DataFrame(rows, columns=['name', 'ヒット', 'ミス'])
+        df['ヒット率'] = (df['ヒット'] / (df['ヒット'] + df['ミス'])).round(3)
+        return df.sort_values('name').reset_index(drop=True)
+
+    def slowest(self, n=20):
+        with self.lock:
+            return sorted(self.events, key=lambda e: -e['ms'])[:n]
+
+    def to_jsonl(self):
+        with self.lock:
+            return "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in self.events)
+
+    def reset(self):
+        with self.lock:
+            self.events.clear()
+            self.hits.clear()
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, metrics, kind, name, detail):
+        self.metrics, self.kind, self.name, self.detail = metrics, kind, name, detail
+
+    def _recreate_cm(self):
+        # デコレーターとして同時に呼ばれても開始時刻を共有しない
+        return _Timer(self.metrics, self.kind, self.name, self.detail)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # st.rerun() などの制御用の例外 (Exception 以外) は失敗に数えない
+        ok = exc_type is None or not issubclass(exc_type, Exception)
+        self.metrics.record(self.kind, self.name, time.perf_counter() - self.start, ok, **self.detail)
+        return False
@@ -0,0 +1,442 @@
+import datetime
+import random
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from gspread.exceptions import WorksheetNotFound
+
+# --- ストレージバックエンド ---
+# データ操作はすべてこのインターフェース経由で行う。
+# 値はシートと同じく文字列で受け渡し、型変換は呼び出し側で行う。
+# ops: {キー: {'op': 'add'|'update'|'upsert'|'delete', 'data': {...}, 'base': updated_at (任意)}}
+# base は編集を始めた時点の updated_at。行の updated_at と違えば他の人が先に保存しているので、
+# data の項目だけを書き、書き込み後の行全体を戻り値の ops に入れて返す。
+# base が "" (編集時に変更時刻が無かった) は確かめようがないので、常に競合として扱う
+
+def to_cell(v):
+    # 読み込み時に型付けした値はシートと同じ表記に戻す
+    if v is None or v is pd.NaT or v is pd.NA: return ""
+    if isinstance(v, pd.Timestamp): return v.strftime("%Y-%m-%d") if v == v.normalize() else v.isoformat()
+    if isinstance(v, pd.Timedelta):
+        minutes = int(v.total_seconds()) // 60
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+    if hasattr(v, 'item'): v = v.item()  # numpy型 → Python型
+    if isinstance(v, float) and pd.isna(v): return ""
+    return v
+
+def _col_letter(n):
+    s = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+class StorageBackend:
+    def read_all(self, worksheet):
+        # (ヘッダー, 全行) を返す
+        raise NotImplementedError
+
+    def read_changes(self, worksheet, key_col, known, limit):
+        # known: {キー: updated_at} と比べて追加・変更された行だけを返す
+        # 戻り値: (ヘッダー, 現在のキー一覧(並び順), 変更行)。変更が limit を超えたら変更行は None
+        raise NotImplementedError
+
+    def read_column(self, worksheet, col_name):
+        raise NotImplementedError
+
+    def write_batch(self, worksheet, key_col, columns, ops):
+        # 戻り値: (書き込んだ ops, 書き込み後のヘッダー)。
+        # 競合した行は書き込み後の行全体を data に入れた update になる (それ以外は ops のまま)
+        raise NotImplementedError
+
+    def allocate_ids(self, worksheet, n):
+        # 複数の端末から同時に呼ばれても重複しない id を n 件返す
+        raise NotImplementedError
+
+    def allocate_id(self, worksheet):
+        return self.allocate_ids(worksheet, 1)[0]
+
+
+ID_BLOCK_SIZE = 20
+
+def _max_id(values):
+    ids = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+    return int(ids.max()) if ids.notna().any() else 0
+
+
+class TimedStorage(StorageBackend):
+    # 各呼び出しの所要時間を metrics (metrics.Metrics) に記録する
+    def __init__(self, inner, metrics):
+        self.inner = inner
+        self.metrics = metrics
+        self.backend = type(inner).__name__
+
+    def _call(self, op, worksheet, *args):
+        with self.metrics.timer("storage", op, worksheet=worksheet, backend=self.backend):
+            return getattr(self.inner, op)(worksheet, *args)
+
+    def read_all(self, worksheet):
+        return self._call("read_all", worksheet)
+
+    def read_changes(self, worksheet, key_col, known, limit):
+        return self._call("read_changes", worksheet, key_col, known, limit)
+
+    def read_column(self, worksheet, col_name):
+        return self._call("read_column", worksheet, col_name)
+
+    def write_batch(self, worksheet, key_col, columns, ops):
+        return self._call("write_batch", worksheet, key_col, columns, ops)
+
+    def allocate_ids(self, worksheet, n):
+        return self._call("allocate_ids", worksheet, n)
+
+
+# --- API 呼び出しの制御 (Sheets API の上限) ---
+# 上限は1分あたりの件数で、サービスアカウントを共有する全端末の合計にかかる。
+# 上限に当たると 429 が返るので、送る前に自分で抑え、当たったら間隔を空けて再試行する。
+QUOTA_PER_MINUTE = 60      # 読み取り・書き込みそれぞれの既定の上限
+QUOTA_BURST = 10           # 続けて送れる件数 (分ごとの上限を超えないよう小さめ)
+RETRY_LIMIT = 5
+RETRY_BASE_DELAY = 1.0     # 秒。1, 2, 4, 8, 16 秒 (+ゆらぎ) と延ばす
+RETRY_MAX_DELAY = 32.0
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_local = threading.local()
+
+@contextmanager
+def background_calls():
+    # この中からの呼び出しは裏の処理として扱う (画面からの呼び出しを先に通す)
+    prev = getattr(_local, 'background', False)
+    _local.background = True
+    try:
+        yield
+    finally:
+        _local.background = prev
+
+def _status(e):
+    return getattr(getattr(e, 'response', None), 'status_code', None)
+
+class TokenBucket:
+    # rate 件/秒で補充され、最大 capacity 件まで貯まる
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiting = 0  # 待っている画面側の呼び出しの数
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, background=False):
+        # 1件分を取るまで待つ。裏の呼び出しは画面側が待っておらず、半分以上残っている時だけ取れる
+        need = 1 + (self.capacity / 2 if background else 0)
+        with self.cond:
+            if not background: self.waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= need and not (background and self.waiting):
+                        self.tokens -= 1
+                        return
+                    self.cond.wait(max((need - self.tokens) / self.rate, 0.05))
+            finally:
+                if not background: self.waiting -= 1
+
+    def drain(self):
+        # 上限に当たった: 貯まっている分を捨て、全員を補充の速さまで落とす
+        with self.cond:
+            self._refill()
+            self.tokens = 0
+
+class ApiScheduler:
+    # Sheets API の呼び出しはすべてここを通す。
+    # 読み取り・書き込みそれぞれトークンバケットで件数を抑え、429 と一時的なエラーは
+    # 指数バックオフ + ゆらぎで再試行する。再試行しても駄目なら例外をそのまま上げる
+    def __init__(self, per_minute=None, burst=QUOTA_BURST, retries=RETRY_LIMIT, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY, metrics=None):
+        per_minute = per_minute or {'read': QUOTA_PER_MINUTE, 'write': QUOTA_PER_MINUTE}
+        self.buckets = {kind: TokenBucket(n / 60, min(burst, n)) for kind, n in per_minute.items()}
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+
+    def call(self, kind, fn, *args, idempotent=True, **kwargs):
+        # idempotent=False (追記・行削除など) は、実行されなかったと分かる 429 の時だけ再試行する
+        bucket = self.buckets[kind]
+        background = getattr(_local, 'background', False)
+        for attempt in range(self.retries + 1):
+            bucket.acquire(background)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                status = _status(e)
+                retry = status == 429 or (idempotent and (status in RETRY_STATUSES or isinstance(e, OSError)))
+                if not retry or attempt == self.retries: raise
+                if status == 429: bucket.drain()
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                if self.metrics: self.metrics.record("api", f"retry:{kind}", delay, ok=False, status=status or type(e).__name__)
+                time.sleep(delay)
+
+
+# --- Google Sheets ---
+class GSheetsStorage(StorageBackend):
+    def __init__(self, conn, scheduler=None):
+        self.conn = conn
+        self.scheduler = scheduler or ApiScheduler()
+        self._ws = {}
+        self._id_blocks = {}
+        self.lock = threading.Lock()
+
+    def _api(self, kind, fn, *args, **kwargs):
+        return self.scheduler.call(kind, fn, *args, **kwargs)
+
+    def _get_ws(self, worksheet, create=False):
+        # gspread の Worksheet を直接取得 (行単位の操作用)。create=True なら無ければ作る
+        if worksheet not in self._ws:
+            try:
+                self._ws[worksheet] = self._api("read", self.conn.client._select_worksheet, worksheet=worksheet)
+            except WorksheetNotFound:
+                if not create: raise
+                self._ws[worksheet] = self._api("write", lambda: self.conn.client._open_spreadsheet().add_worksheet(title=worksheet, rows=1000, cols=10), idempotent=False)
+        return self._ws[worksheet]
+
+    def _ensure_header(self, ws, columns):
+        # ヘッダー行に無いカラムだけを末尾に追加
+        header = self._api("read", ws.row_values, 1)
+        missing = [c for c in columns if c not in header]
+        if missing:
+            header = header + missing
+            if len(header) > ws.col_count: self._api("write", ws.add_cols, len(header) - ws.col_count, idempotent=False)
+            self._api("write", ws.batch_update, [{'range': 'A1', 'values': [header]}], value_input_option="USER_ENTERED")
+        return header
+
+    def read_all(self, worksheet):
+        try:
+            values = self._api("read", self._get_ws(worksheet).get_all_values)
+        except WorksheetNotFound:
+            return [], []  # まだ作られていないシートは空として扱う (書き込み時に作る)
+        return (values[0], values[1:]) if values else ([], [])
+
+    def _key_and_stamps(self, ws, header, key_col):
+        # キー列と updated_at 列を1回で読む (差分同期と書き込み時の競合確認で共通)。
+        # updated_at 列が無ければ stamps は None
+        key_letter = _col_letter(header.index(key_col) + 1)
+        ranges = [f"{key_letter}2:{key_letter}"]
+        if 'updated_at' in header:
+            stamp_letter = _col_letter(header.index('updated_at') + 1)
+            ranges.append(f"{stamp_letter}2:{stamp_letter}")
+        cols = self._api("read", ws.batch_get, ranges)
+        keys = [r[0] if r else "" for r in cols[0]]
+        if len(cols) < 2: return keys, None
+        stamps = [r[0] if r else "" for r in cols[1]]
+        return keys, stamps + [""] * (len(keys) - len(stamps))
+
+    def read_changes(self, worksheet, key_col, known, limit):
+        # キー列と updated_at 列だけを読み、変更のあった行だけを取得する
+        ws = self._get_ws(worksheet)
+        header = self._api("read", ws.row_values, 1)
+        if key_col not in header: return header, [], None
+        keys, stamps = self._key_and_stamps(ws, header, key_col)
+        stamps = stamps or [""] * len(keys)
+
+        changed = [i for i, (k, t) in enumerate(zip(keys, stamps)) if k and known.get(k) != t]
+        if len(changed) > limit: return header, keys, None
+        if not changed: return header, keys, []
+        last = _col_letter(len(header))
+        fetched = self._api("read", ws.batch_get, [f"A{i + 2}:{last}{i + 2}" for i in changed])
+        return header, keys, [r[0] if r else [] for r in fetched]
+
+    def read_column(self, worksheet, col_name):
+        # 1カラム分だけを取得 (ヘッダー除く)
+        ws = self._get_ws(worksheet)
+        header = self._api("read", ws.row_values, 1)
+        if col_name not in header: return []
+        return self._api("read", ws.col_values, header.index(col_name) + 1)[1:]
+
+    def write_batch(self, worksheet, key_col, columns, ops):
+        # キー列と updated_at 列を1回で読み、更新・追記・削除をそれぞれ1リクエストにまとめて送る
+        ws = self._get_ws(worksheet, create=True)
+        header = self._ensure_header(ws, list(dict.fromkeys(columns + [c for op in ops.values() for c in op['data']])))
+        keys, stamps = self._key_and_stamps(ws, header, key_col)
+        rows = {k: i + 2 for i, k in enumerate(keys) if k}
+
+        cells, appends, deletes, updated, conflicts = [], [], [], [], []
+        for key, op in ops.items():
+            row = rows.get(key)
+            if op['op'] == 'delete':
+                if row: deletes.append(row)
+            elif row:
+                # 店舗・従業員の追加は登録済みなら何もしない
+                # (記録の id は allocate_id で一意なので、既にあるのは再送時だけ → 同じ行を上書き)
+                if op['op'] == 'add' and key_col != 'id': continue
+                if op.get('base') is not None and (not op['base'] or stamps is None or stamps[row - 2] != op['base']): conflicts.append(row)
+                updated.append(row)
+                cells += [{'range': f"{_col_letter(header.index(c) + 1)}{row}", 'values': [[to_cell(v)]]} for c, v in op['data'].items()]
+            elif op['op'] in ('add', 'upsert'):
+                appends.append({key_col: key, **op['data']})
+
+        # 書き込む直前に行番号の先のキーを読み直す (間で行の挿入・削除があれば別の行を書き換えてしまう)。
+        # 競合した行はここで行全体を読み、変えた項目だけを重ねた内容を返す
+        written = ops
+        targets = sorted(set(updated + deletes))
+        if targets:
+            last, key_letter = _col_letter(len(header)), _col_letter(header.index(key_col) + 1)
+            fetched = self._api("read", ws.batch_get, [f"A{r}:{last}{r}" if r in conflicts else f"{key_letter}{r}" for r in targets])
+            current = {r: (v[0] if v else []) for r, v in zip(targets, fetched)}
+            key_at = {r: k for k, r in rows.items()}
+            for r in targets:
+                i = header.index(key_col) if r in conflicts else 0
+                if (current[r][i] if len(current[r]) > i else "") != key_at[r]:
+                    raise RuntimeError(f"{worksheet}: 書き込み中に行の位置が変わりました (行 {r})。読み直してから送り直します")
+            if conflicts:
+                written = dict(ops)
+                for r in conflicts:
+                    values = current[r] + [""] * (len(header) - len(current[r]))
+                    k = key_at[r]
+                    row = {c: v for c, v in zip(header, values) if c != key_col}
+                    written[k] = {'op': 'update', 'data': {**row, **ops[k]['data']}}
+
+        if cells:
+            self._api("write", ws.batch_update, cells, value_input_option="USER_ENTERED")
+        if appends:
+            self._api("write", ws.append_rows, [[to_cell(r.get(c, "")) for c in header] for r in appends],
+                      value_input_option="USER_ENTERED", table_range="A1", idempotent=False)
+        if deletes:
+            self._api("write", ws.spreadsheet.batch_update, {'requests': [
+                {'deleteDimension': {'range': {'sheetId': ws.id, 'dimension': 'ROWS', 'startIndex': r - 1, 'endIndex': r}}}
+                for r in sorted(deletes, reverse=True)
+            ]}, idempotent=False)
+        return written, header
+
+    def allocate_ids(self, worksheet, n):
+        with self.lock:
+            block = self._id_blocks.setdefault(worksheet, [])
+            if len(block) < n: block += self._reserve_blocks(worksheet, -(-(n - len(block)) // ID_BLOCK_SIZE))
+            ids, self._id_blocks[worksheet] = block[:n], block[n:]
+            return ids
+
+    def _reserve_blocks(self, worksheet, count):
+        # 「{シート名}_ids」に count 行追記して、1行につき ID_BLOCK_SIZE 件の id を予約する。
+        # 追記される行番号は Sheets 側で一意に決まるので、行番号からブロックを決めれば重複しない
+        ws = self._get_ws(f"{worksheet}_ids", create=True)
+        header = self._api("read", ws.row_values, 1)
+        if len(header) < 2:
+            # 初回のみ: 既存の id より後ろを起点にする
+            header = ['base', str(_max_id(self.read_column(worksheet, 'id')) + 1)]
+            self._api("write", ws.batch_update, [{'range': 'A1', 'values': [header]}], value_input_option="RAW")
+        stamp = datetime.datetime.now().isoformat(timespec="seconds")
+        res = self._api("write", ws.append_rows, [[stamp, ""]] * count, value_input_option="RAW", table_range="A1", idempotent=False)
+        m = re.search(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?", res['updates']['updatedRange'])
+        first, last = int(m.group(1)), int(m.group(2) or m.group(1))
+        base = int(header[1])
+        return list(range(base + (first - 2) * ID_BLOCK_SIZE, base + (last - 1) * ID_BLOCK_SIZE))
+
+
+# --- ローカル SQLite ---
+# 大規模店舗・オフライン・負荷試験用。シートごとに1テーブル、値はすべて TEXT。
+# 行の並び順は _row (挿入順) で保持する。
+SQLITE_INDEXES = {
+    "visits": ['store_name', 'visit_date'],
+    "visit_members": ['visit_id', 'person'],
+}
+
+def _q(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+class SQLiteStorage(StorageBackend):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.Lock()
+
+    def _columns(self, worksheet):
+        return [r[1] for r in self.db.execute(f"PRAGMA table_info({_q(worksheet)})") if r[1] != '_row']
+
+    def _ensure_table(self, worksheet, key_col, columns):
+        header = self._columns(worksheet)
+        if not header:
+            self.db.execute(f"CREATE TABLE {_q(worksheet)} (_row INTEGER PRIMARY KEY AUTOINCREMENT)")
+        for c in columns:
+            if c not in header:
+                self.db.execute(f"ALTER TABLE {_q(worksheet)} ADD COLUMN {_q(c)} TEXT NOT NULL DEFAULT ''")
+                header.append(c)
+        for c in [key_col] + SQLITE_INDEXES.get(worksheet, []):
+            if c in header:
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {_q(f'ix_{worksheet}_{c}')} ON {_q(worksheet)} ({_q(c)})")
+        return header
+
+    def read_all(self, worksheet):
+        with self.lock:
+            header = self._columns(worksheet)
+            if not header: return [], []
+            rows = self.db.execute(f"SELECT {', '.join(map(_q, header))} FROM {_q(worksheet)} ORDER BY _row").fetchall()
+        return header, [list(r) for r in rows]
+
+    def read_changes(self, worksheet, key_col, known, limit):
+        with self.lock:
+            header = self._columns(worksheet)
+            if key_col not in header: return header, [], None
+            stamp = _q('updated_at') if 'updated_at' in header else "''"
+            pairs = self.db.execute(f"SELECT {_q(key_col)}, {stamp} FROM {_q(worksheet)} ORDER BY _row").fetchall()
+            keys = [k for k, _ in pairs]
+            changed = [k for k, t in pairs if k and known.get(k) != t]
+            if len(changed) > limit: return header, keys, None
+            rows = []
+            for i in range(0, len(changed), 500):
+                chunk = changed[i:i + 500]
+                rows += self.db.execute(
+                    f"SELECT {', '.join(map(_q, header))} FROM {_q(worksheet)} WHERE {_q(key_col)} IN ({', '.join('?' * len(chunk))}) ORDER BY _row",
+                    chunk,
+                ).fetchall()
+        return header, keys, [list(r) for r in rows]
+
+    def read_column(self, worksheet, col_name):
+        with self.lock:
+            if col_name not in self._columns(worksheet): return []
+            return [r[0] for r in self.db.execute(f"SELECT {_q(col_name)} FROM {_q(worksheet)} ORDER BY _row")]
+
+    def write_batch(self, worksheet, key_col, columns, ops):
+        # 1トランザクションでまとめて反映
+        with self.lock, self.db:
+            header = self._ensure_table(worksheet, key_col, list(dict.fromkeys(columns + [c for op in ops.values() for c in op['data']])))
+            table, key = _q(worksheet), _q(key_col)
+            stamp = _q('updated_at') if 'updated_at' in header else "''"
+            written = ops
+            for k, op in ops.items():
+                if op['op'] == 'delete':
+                    self.db.execute(f"DELETE FROM {table} WHERE {key} = ?", (k,))
+                    continue
+                exists = self.db.execute(f"SELECT {stamp} FROM {table} WHERE {key} = ? LIMIT 1", (k,)).fetchone()
+                data = {c: str(to_cell(v)) for c, v in op['data'].items()}
+                if exists:
+                    if (op['op'] == 'add' and key_col != 'id') or not data: continue
+                    self.db.execute(f"UPDATE {table} SET {', '.join(f'{_q(c)} = ?' for c in data)} WHERE {key} = ?", list(data.values()) + [k])
+                    if op.get('base') is not None and (not op['base'] or exists[0] != op['base']):
+                        # 他の人が先に保存していた → 書き込み後の行全体を返す
+                        values = self.db.execute(f"SELECT {', '.join(map(_q, header))} FROM {table} WHERE {key} = ? LIMIT 1", (k,)).fetchone()
+                        if written is ops: written = dict(ops)
+                        written[k] = {'op': 'update', 'data': {c: v for c, v in zip(header, values) if c != key_col}}
+                elif op['op'] in ('add', 'upsert'):
+                    data = {key_col: k, **data}
+                    self.db.execute(f"INSERT INTO {table} ({', '.join(map(_q, data))}) VALUES ({', '.join('?' * len(data))})", list(data.values()))
+        return written, header
+
+    def allocate_ids(self, worksheet, n):
+        # カウンターを進めてから読む。UPDATE で書き込みロックを取るので別プロセスとも重複しない
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS _ids (worksheet TEXT PRIMARY KEY, next INTEGER NOT NULL)")
+            if not self.db.execute("SELECT 1 FROM _ids WHERE worksheet = ?", (worksheet,)).fetchone():
+                ids = [r[0] for r in self.db.execute(f"SELECT id FROM {_q(worksheet)}")] if 'id' in self._columns(worksheet) else []
+                self.db.execute("INSERT OR IGNORE INTO _ids VALUES (?, ?)", (worksheet, _max_id(ids) + 1))
+            self.db.execute("UPDATE _ids SET next = next + ? WHERE worksheet = ?", (n, worksheet))
+            end = self.db.execute("SELECT next FROM _ids WHERE worksheet = ?", (worksheet,)).fetchone()[0]
+            return list(range(end - n, end))